@@ -3,53 +3,66 @@ Analyzes correlation between Functional Connectivity (FC) and cognitive scores (
 Author: Emre Pelzer
 """
 
+import argparse
 import os
-import numpy as np
 import pandas as pd
-from scipy.stats import pearsonr
 
-fc_dir = "features_fc"
+from bootstrap import add_bootstrap_arguments, bootstrap_correlations
+from feature_store import FeatureStore
+from manifest import load_scores
+from mass_stats import correlation_table
+from permutation import add_permutation_arguments, permutation_test_correlations
+from profiling import add_profile_argument, enable, stage
+
+parser = argparse.ArgumentParser(description="FC vs cognition correlations")
+parser.add_argument("--features", default=None,
+                    help="wide CSV (subject + one column per feature, e.g. fc_edges.csv) used instead of mean FC per seed")
+add_permutation_arguments(parser, default_n_perm=0)
+add_bootstrap_arguments(parser)
+add_profile_argument(parser)
+args = parser.parse_args()
+enable(args.profile)
+
+fc_store = "features_fc.h5"
 cog_file = "cognitive_scores_normalized.csv"
 output_file = "fc_correlation_results.csv"
+if args.features:
+    output_file = f"{os.path.splitext(os.path.basename(args.features))[0]}_correlation_results.csv"
 
 
 # Load cognitive scores
-df = pd.read_csv(cog_file)
-cog_scores = df.set_index("subject")
-
-# Collect mean FC values
-fc_summary = []
-
-for fname in os.listdir(fc_dir):
-    if fname.endswith("_fc.npy"):
-        parts = fname.replace(".npy", "").split("_")
-        if len(parts) >= 3:
-            sid = parts[0]
-            seed = "_".join(parts[1:-1])  # seed names with underscores
-            fc_map = np.load(os.path.join(fc_dir, fname))
-            if fc_map.ndim == 3:
-                mean_fc = np.mean(fc_map)
-                fc_summary.append({"subject": sid, "seed": seed, "mean_fc": mean_fc})
-            else:
-                print(f"⚠️ Skipping {fname} due to unexpected shape: {fc_map.shape}")
-
-fc_df = pd.DataFrame(fc_summary)
-
-# Merge with cognition data
-merged = fc_df.merge(cog_scores, left_on="subject", right_index=True)
-
-# Correlations
-results = []
-for seed in merged["seed"].unique():
-    seed_data = merged[merged["seed"] == seed]
-    for cog_score in cog_scores.columns:
-        r, p = pearsonr(seed_data["mean_fc"], seed_data[cog_score])
-        results.append({
-            "seed": seed,
-            "cog_score": cog_score,
-            "r": r,
-            "p": p
-        })
-
-pd.DataFrame(results).to_csv(output_file, index=False)
+cog_scores = load_scores(cog_file)
+
+if args.features:
+    # Subjects x features matrix as written, e.g. ROI-to-ROI edges from extract_roi_connectivity.py
+    fc_wide = pd.read_csv(args.features, dtype={"subject": str}).set_index("subject")
+else:
+    # Mean FC values (precomputed per map in the feature store)
+    with stage("load"), FeatureStore(fc_store, mode="r") as store:
+        fc_df = store.summaries()[["subject", "seed", "mean_fc"]]
+
+    # Subjects x seeds matrix aligned with the cognition table
+    fc_wide = fc_df.pivot(index="subject", columns="seed", values="mean_fc")
+merged = fc_wide.join(cog_scores, how="inner")
+
+with stage("statistics"):
+    # All seed x score correlations at once
+    results = correlation_table(merged[fc_wide.columns], merged[cog_scores.columns], score_col="cog_score")
+
+    # Optional permutation p-values, FWE-corrected with the max |r| over all seed x score pairs
+    if args.n_perm > 0:
+        _, p_perm, p_fwe = permutation_test_correlations(merged[fc_wide.columns], merged[cog_scores.columns],
+                                                         n_perm=args.n_perm, seed=args.perm_seed)
+        results["p_perm"] = p_perm.ravel()
+        results["p_perm_fwe"] = p_fwe.ravel()
+
+    # Optional bootstrap confidence intervals of r (percentile and BCa)
+    if args.bootstrap > 0:
+        _, ci, ci_bca = bootstrap_correlations(merged[fc_wide.columns], merged[cog_scores.columns],
+                                               n_boot=args.bootstrap, seed=args.boot_seed, level=args.ci_level,
+                                               max_memory_mb=args.boot_memory_mb)
+        results["ci_low"], results["ci_high"] = ci[0].ravel(), ci[1].ravel()
+        results["bca_low"], results["bca_high"] = ci_bca[0].ravel(), ci_bca[1].ravel()
+
+results.to_csv(output_file, index=False)
 print(f"\n✅ FC–Cognition correlations saved to: {output_file}")
\ No newline at end of file
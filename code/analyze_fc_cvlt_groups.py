@@ -3,61 +3,56 @@ Performs group comparison of FC features between high and low CVLT1 (memory) per
 Author: Emre Pelzer
 """
 
+import argparse
 import os
 import pandas as pd
-import numpy as np
-import nibabel as nib
 from scipy.stats import ttest_ind
 import matplotlib.pyplot as plt
 
-feature_dir = "features_fc"
+from feature_store import FeatureStore
+from manifest import load_scores
+from permutation import add_permutation_arguments, permutation_test_groups
+from profiling import add_profile_argument, enable, stage
+
+parser = argparse.ArgumentParser(description="FC group comparison between low and high CVLT performers")
+parser.add_argument("--features", default=None,
+                    help="wide CSV (subject + one column per feature, e.g. fc_edges.csv) used instead of mean FC per seed")
+add_permutation_arguments(parser)
+add_profile_argument(parser)
+args = parser.parse_args()
+enable(args.profile)
+
+feature_store = "features_fc.h5"
 score_file = "cognitive_scores_normalized.csv"
 cvlt_cols = ["CVLT1", "CVLT2", "CVLT3", "CVLT4", "CVLT5", "CVLT6", "CVLT7", "CVLT8", "CVLT9", "CVLT10"]
 output_csv = "fc_cvlt_group_comparison.csv"
 output_dir = "fc_cvlt_plots"
+if args.features:
+    stem = os.path.splitext(os.path.basename(args.features))[0]
+    output_csv = f"{stem}_cvlt_group_comparison.csv"
+    output_dir = f"{stem}_cvlt_plots"
 os.makedirs(output_dir, exist_ok=True)
 
-df = pd.read_csv(score_file)
+df = load_scores(score_file)
 df["CVLT_total"] = df[cvlt_cols].sum(axis=1)
 
 # Median split
 median_cvlt = df["CVLT_total"].median()
 df["cvlt_group"] = ["high" if score >= median_cvlt else "low" for score in df["CVLT_total"]]
 
-results = []
-
-# Analysis
-for fname in os.listdir(feature_dir):
-    if not fname.endswith("_fc.npy"):
-        continue
-
-    parts = fname.replace(".npy", "").split("_")
-    if len(parts) < 3:
-        continue
-
-    subject = parts[0]
-    seed = "_".join(parts[1:-1])  # handles seeds with underscores
-    fc_path = os.path.join(feature_dir, fname)
-
-    if subject not in df["subject"].values:
-        continue
+if args.features:
+    # Wide feature table (e.g. ROI-to-ROI edges) in the same long layout as the store summaries
+    fc_df = pd.read_csv(args.features, dtype={"subject": str}).melt(id_vars="subject", var_name="seed", value_name="mean_fc")
+else:
+    # Mean FC per subject and seed (precomputed in the feature store)
+    with stage("load"), FeatureStore(feature_store, mode="r") as store:
+        fc_df = store.summaries()[["subject", "seed", "mean_fc"]]
 
-    try:
-        data = np.load(fc_path)
-        mean_val = np.mean(data[np.isfinite(data)])
-
-        group = df[df["subject"] == subject]["cvlt_group"].values[0]
-        results.append((seed, subject, group, mean_val))
-
-    except Exception as e:
-        print(f"⚠️ Skipped {fname}: {e}")
-
-
-res_df = pd.DataFrame(results, columns=["seed", "subject", "group", "mean_fc"])
+groups = df["cvlt_group"].rename("group").reset_index()
+res_df = fc_df.merge(groups, on="subject")
 summary_rows = []
 
-for seed in res_df["seed"].unique():
-    seed_data = res_df[res_df["seed"] == seed]
+for seed, seed_data in res_df.groupby("seed", sort=False):
     low_vals = seed_data[seed_data["group"] == "low"]["mean_fc"]
     high_vals = seed_data[seed_data["group"] == "high"]["mean_fc"]
 
@@ -82,5 +77,16 @@ for seed in res_df["seed"].unique():
         plt.savefig(plot_path)
         plt.close()
 
-pd.DataFrame(summary_rows).to_csv(output_csv, index=False)
+summary_df = pd.DataFrame(summary_rows)
+
+# Permutation p-values for all seeds at once, with max-|t| FWE correction across seeds
+if args.n_perm > 0 and not summary_df.empty:
+    wide = res_df.pivot(index="subject", columns="seed", values="mean_fc")[summary_df["seed"]]
+    is_low = (groups.set_index("subject")["group"].reindex(wide.index) == "low").to_numpy()
+    with stage("statistics"):
+        _, p_perm, p_fwe = permutation_test_groups(wide.to_numpy(), is_low, n_perm=args.n_perm, seed=args.perm_seed)
+    summary_df["p_perm"] = p_perm
+    summary_df["p_perm_fwe"] = p_fwe
+
+summary_df.to_csv(output_csv, index=False)
 print(f"\n✅ Group comparisons saved to: {output_csv}")
@@ -3,6 +3,7 @@ Performs group comparison of SD-BOLD values between high and low CVLT1 (memory)
 Author: Emre Pelzer
 """
 
+import argparse
 import os
 import pandas as pd
 import numpy as np
@@ -10,6 +11,18 @@ import nibabel as nib
 from scipy.stats import ttest_ind
 import matplotlib.pyplot as plt
 
+from manifest import Manifest
+from permutation import add_permutation_arguments, permutation_test_groups
+from prefetch import add_prefetch_arguments, prefetch
+from profiling import add_profile_argument, enable, stage
+
+parser = argparse.ArgumentParser(description="SD-BOLD group comparison between low and high CVLT performers")
+add_permutation_arguments(parser)
+add_prefetch_arguments(parser)
+add_profile_argument(parser)
+args = parser.parse_args()
+enable(args.profile)
+
 feature_dir = "features_sdbold"
 score_file = "cognitive_scores_normalized.csv"
 cvlt_cols = ["CVLT1", "CVLT2", "CVLT3", "CVLT4", "CVLT5", "CVLT6", "CVLT7", "CVLT8", "CVLT9", "CVLT10", "CVLT11", "CVLT12", "CVLT13"]
@@ -17,31 +30,34 @@ output_csv = "sdbold_cvlt_group_comparison.csv"
 output_dir = "sdbold_cvlt_plots"
 os.makedirs(output_dir, exist_ok=True)
 
-df = pd.read_csv(score_file)
+# Maps and scores indexed by subject once, instead of a DataFrame scan per file
+manifest = Manifest(score_file, kinds=["sdbold"], dirs={"sdbold": feature_dir})
+df = manifest.scores
 df["CVLT_total"] = df[cvlt_cols].sum(axis=1)
 
 # Median split
 median_cvlt = df["CVLT_total"].median()
 df["cvlt_group"] = ["high" if score >= median_cvlt else "low" for score in df["CVLT_total"]]
 
-results = []
+maps = [(subject, manifest.path("sdbold", subject)) for subject in manifest.subjects("sdbold")]
 
-# Analysis on each region
-for fname in os.listdir(feature_dir):
-    if not fname.endswith("_sdbold.nii.gz"):
-        continue
 
-    subject = fname.split("_")[0]
-    sdbold_path = os.path.join(feature_dir, fname)
+def read_map(item):
+    subject, sdbold_path = item
+    with stage("read", subject):
+        return nib.load(sdbold_path).get_fdata()
 
-    if subject not in df["subject"].values:
-        continue
 
+results = []
+
+# Analysis on each region; the next maps are read in background threads meanwhile
+for (subject, sdbold_path), data, error in prefetch(maps, read_map, args.prefetch, args.prefetch_memory_mb):
     try:
-        data = nib.load(sdbold_path).get_fdata()
+        if error is not None:
+            raise error
         mean_val = np.mean(data[data > 0])  # ignore empty voxels
 
-        group = df[df["subject"] == subject]["cvlt_group"].values[0]
+        group = df.at[subject, "cvlt_group"]
         results.append((subject, group, mean_val))
 
     except Exception as e:
@@ -64,6 +80,15 @@ summary = {
     "n_low": len(low_vals),
     "n_high": len(high_vals)
 }
+
+# Permutation p-value (label shuffles evaluated in one batched pass)
+if args.n_perm > 0:
+    is_low = (res_df["group"] == "low").to_numpy()
+    with stage("statistics"):
+        _, p_perm, _ = permutation_test_groups(res_df[["mean_sdbold"]].to_numpy(), is_low,
+                                               n_perm=args.n_perm, seed=args.perm_seed)
+    summary["p_perm"] = p_perm[0]
+
 pd.DataFrame([summary]).to_csv(output_csv, index=False)
 print(f"✅ Saved result to {output_csv}")
 
@@ -0,0 +1,157 @@
+"""
+Voxelwise correlation between FC (per seed) or SD-BOLD maps and cognitive scores, saved as r/p NIfTI maps.
+Author: Emre Pelzer
+
+With --n-perm N, clusters of voxels with p < --cluster-p also get a p-value from N score permutations
+(largest cluster under the null); see multiple_comparisons.py for FDR of the p maps.
+"""
+
+import argparse
+import os
+import nibabel as nib
+import numpy as np
+
+from feature_store import FeatureStore
+from manifest import Manifest
+from mass_stats import StreamingCorrelation
+from multiple_comparisons import cluster_inference, permutation_cluster_null, structures
+from permutation import add_permutation_arguments
+from prefetch import add_prefetch_arguments, prefetch
+from profiling import add_profile_argument, enable, stage
+
+fc_store = "features_fc.h5"
+sdbold_dir = "features_sdbold"
+cog_file = "cognitive_scores_normalized.csv"
+output_dir = "voxelwise_maps"
+
+
+def correlate_maps(name, map_loader, subjects, scores, prefetch_depth=0, prefetch_memory_mb=1024):
+    """
+    Streams subjects through a StreamingCorrelation for one map type.
+    map_loader(subject) returns (map, affine) or None; the next prefetch_depth subjects are loaded in
+    background threads. Returns (r, p, n, shape, affine, subjects with a map) or None.
+    """
+    accumulator = None
+    used = []
+    shape = affine = None
+
+    def read(subject):
+        with stage("read", subject):
+            return map_loader(subject)
+
+    for subject, loaded, error in prefetch(subjects, read, prefetch_depth, prefetch_memory_mb):
+        if error is not None:
+            raise error
+        if loaded is None:
+            continue
+        data, subject_affine = loaded
+
+        if accumulator is None:
+            shape, affine = data.shape, subject_affine
+            accumulator = StreamingCorrelation(int(np.prod(shape)), scores.shape[1])
+        elif data.shape != shape:
+            print(f"⚠️ Skipped {subject} for {name}: grid {data.shape} differs from {shape}")
+            continue
+
+        # Voxels without signal are exactly 0 and are treated as missing
+        with stage("statistics", subject):
+            data = np.where(data == 0, np.nan, data)
+            accumulator.update(data, scores.loc[subject].to_numpy(dtype=np.float64))
+        used.append(subject)
+
+    if accumulator is None:
+        return None
+    with stage("statistics"):
+        r, p, n = accumulator.result()
+    return r, p, n, shape, affine, used
+
+
+def save_maps(name, result, score_names, output_dir):
+    r, p, n, shape, affine, _ = result
+    for j, score in enumerate(score_names):
+        for stat, values in (("r", r[:, j]), ("p", p[:, j])):
+            img = nib.Nifti1Image(values.reshape(shape).astype(np.float32), affine)
+            with stage("save"):
+                img.to_filename(os.path.join(output_dir, f"{name}_{score}_{stat}.nii.gz"))
+    print(f"✅ Saved voxelwise maps for {name} (n = {int(np.nanmax(n))} subjects)")
+
+
+def save_clusters(name, result, map_loader, scores, args):
+    """Cluster-level inference for every score of one map type: {name}_{score}_clusters.csv and .nii.gz."""
+    r, p, n, shape, affine, subjects = result
+    for j, score in enumerate(scores.columns):
+        tested = np.flatnonzero(n[:, j] >= 3)
+        null = permutation_cluster_null(map_loader, subjects, scores.loc[subjects, score], shape, args.n_perm,
+                                        args.cluster_p, args.perm_seed, tested, args.connectivity,
+                                        args.perm_memory_mb, args.prefetch, args.prefetch_memory_mb)
+        with stage("statistics"):
+            table, labels = cluster_inference(r[:, j].reshape(shape), p[:, j].reshape(shape), affine, null,
+                                              args.cluster_p, args.cluster_alpha, args.connectivity)
+        base = os.path.join(args.output_dir, f"{name}_{score}_clusters")
+        with stage("save"):
+            table.to_csv(f"{base}.csv", index=False)
+            nib.Nifti1Image(labels, affine).to_filename(f"{base}.nii.gz")
+        n_significant = int((table["p_cluster"] < args.cluster_alpha).sum()) if len(table) else 0
+        print(f"✅ {name} / {score}: {len(table)} clusters at p < {args.cluster_p}, {n_significant} significant "
+              f"(largest null cluster, 95th percentile: {np.percentile(null, 95):.0f} voxels)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Voxelwise brain-behavior correlation maps")
+    parser.add_argument("--feature", choices=["fc", "sdbold"], default="fc")
+    parser.add_argument("--scores", default=None, help="comma-separated score columns (default: all)")
+    parser.add_argument("--seeds", default=None, help="comma-separated seeds for --feature fc (default: all)")
+    parser.add_argument("--store", default=fc_store)
+    parser.add_argument("--sdbold-dir", default=sdbold_dir)
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--cluster-p", type=float, default=0.001, help="voxel p threshold that forms the clusters")
+    parser.add_argument("--cluster-alpha", type=float, default=0.05, help="cluster p below which a cluster is kept in the map")
+    parser.add_argument("--connectivity", type=int, choices=sorted(structures), default=26)
+    parser.add_argument("--perm-memory-mb", type=int, default=512, help="memory for the running sums of a permutation batch")
+    add_permutation_arguments(parser, default_n_perm=0)
+    add_prefetch_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    manifest = Manifest(cog_file, kinds=["sdbold"], dirs={"sdbold": args.sdbold_dir})
+    cog_scores = manifest.scores
+    if args.scores:
+        cog_scores = cog_scores[args.scores.split(",")]
+
+    if args.feature == "fc":
+        with FeatureStore(args.store, mode="r") as store:
+            subjects = [s for s in store.subjects() if s in cog_scores.index]
+            seeds = args.seeds.split(",") if args.seeds else sorted({seed for s in subjects for seed in store.seeds(s)})
+
+            for seed in seeds:
+                def load_fc(subject):
+                    if not store.has_map(subject, seed):
+                        return None
+                    return store.read_map(subject, seed), store.read_affine(subject, seed)
+
+                result = correlate_maps(seed, load_fc, subjects, cog_scores, args.prefetch, args.prefetch_memory_mb)
+                if result is None:
+                    print(f"⚠️ No FC maps found for {seed}")
+                    continue
+                save_maps(f"{seed}_fc", result, cog_scores.columns, args.output_dir)
+                if args.n_perm > 0:
+                    save_clusters(f"{seed}_fc", result, load_fc, cog_scores, args)
+    else:
+        def load_sdbold(subject):
+            path = manifest.path("sdbold", subject)
+            if path is None:
+                return None
+            img = nib.load(path)
+            return img.get_fdata(dtype=np.float32), img.affine
+
+        result = correlate_maps("sdbold", load_sdbold, manifest.subjects("sdbold"), cog_scores,
+                                args.prefetch, args.prefetch_memory_mb)
+        if result is None:
+            print("⚠️ No SD-BOLD maps found")
+        else:
+            save_maps("sdbold", result, cog_scores.columns, args.output_dir)
+            if args.n_perm > 0:
+                save_clusters("sdbold", result, load_sdbold, cog_scores, args)
@@ -3,12 +3,19 @@ Applies False Discovery Rate (FDR) correction to p-values from correlation or gr
 Author: Emre Pelzer
 """
 
+import argparse
 import pandas as pd
-from statsmodels.stats.multitest import multipletests
 import os
 
+from multiple_comparisons import correct_table, p_columns
+
 # Files for FDR
-files = ["fc_correlation_results.csv", "sdbold_correlation_results.csv"]
+files = ["fc_correlation_results.csv", "sdbold_correlation_results.csv", "fc_glm_results.csv", "sdbold_glm_results.csv"]
+
+parser = argparse.ArgumentParser(description="FDR correction of the result tables")
+parser.add_argument("--method", choices=["bh", "by"], default="bh", help="Benjamini-Hochberg or Benjamini-Yekutieli")
+parser.add_argument("--alpha", type=float, default=0.05)
+args = parser.parse_args()
 
 for file in files:
     if not os.path.exists(file):
@@ -17,19 +24,14 @@ for file in files:
 
     df = pd.read_csv(file)
 
-    if "p" not in df.columns:
-        print(f"❌ No 'p' column found in {file} — skipping FDR correction.")
+    # FDR correction on the p column (p, p_value, ...), adds p_fdr and significant_fdr
+    try:
+        df, column = correct_table(df, alpha=args.alpha, method=args.method)
+    except ValueError:
+        print(f"❌ No p-value column ({', '.join(p_columns)}) found in {file} — skipping FDR correction.")
         continue
 
-    # FDR correction
-    pvals = df["p"].values
-    rejected, pvals_corrected, _, _ = multipletests(pvals, alpha=0.05, method="fdr_bh")
-
-    # Add results to dataframe
-    df["p_fdr"] = pvals_corrected
-    df["significant_fdr"] = rejected
-
     # Save
     output_file = file.replace(".csv", "_fdr.csv")
     df.to_csv(output_file, index=False)
-    print(f"✅ FDR correction applied and saved to {output_file}")
\ No newline at end of file
+    print(f"✅ FDR correction applied to '{column}' and saved to {output_file}")
@@ -0,0 +1,262 @@
+"""
+Benchmarks the extraction and statistics hot paths on synthetic 4D fMRI runs with planted seed correlations.
+Author: Emre Pelzer
+
+Each stage runs in a fresh process so its peak RSS is measured on its own. Results can be saved as a
+JSON baseline and later runs compared against it to catch regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import nibabel as nib
+import numpy as np
+
+# Seeds with planted signal: the first two share one network, the others are independent noise
+planted_seeds = {
+    "mPFC": [1, 55, -3],
+    "PCC": [1, -61, 38],
+    "AINS_left": [-44, 13, 1],
+    "Hippocampus_right": [30, -8, -14],
+}
+planted_rho = 0.6  # correlation of each network voxel with the shared signal, so mPFC-PCC FC is about rho ** 2
+min_planted_fc = 0.5 * planted_rho ** 2  # the fc_extraction stage fails below this
+
+
+def mni_affine(shape, voxel_size):
+    """Diagonal affine that puts the middle of the grid at MNI (0, -3, 12), the centre of the seeds above."""
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = np.array([0, -3, 12]) - voxel_size * (np.asarray(shape) - 1) / 2
+    return affine
+
+
+def seeds_in_grid(affine, shape):
+    """{seed: (x, y, z) voxel} for the planted seeds that fall inside the grid (small grids lose some)."""
+    inv_affine = np.linalg.inv(affine)
+    voxels = {}
+    for name, coords in planted_seeds.items():
+        voxel = np.round(inv_affine[:3, :3] @ coords + inv_affine[:3, 3]).astype(int)
+        if np.all(voxel >= 0) and np.all(voxel < shape[:3]):
+            voxels[name] = tuple(voxel)
+    return voxels
+
+
+def make_synthetic_run(path, shape, n_timepoints, voxel_size=3.0, rho=planted_rho, radius=6, random_state=0):
+    """
+    Writes a synthetic 4D run. Voxels within radius mm of mPFC and PCC share one signal with correlation
+    rho to it, so mPFC-PCC FC is about rho ** 2; all other voxels are independent noise around 1000.
+    """
+    from roi_extract import sphere_indices
+
+    rng = np.random.default_rng(random_state)
+    affine = mni_affine(shape, voxel_size)
+    data = rng.normal(1000, 10, size=(int(np.prod(shape)), n_timepoints)).astype(np.float32)
+
+    signal = rng.normal(size=n_timepoints)
+    signal = (signal - signal.mean()) / signal.std()
+    voxels = seeds_in_grid(affine, shape)
+    network = {name: planted_seeds[name] for name in ("mPFC", "PCC") if name in voxels}
+    for idx in sphere_indices(network, radius, affine, shape).values():
+        noise = rng.normal(size=(len(idx), n_timepoints))
+        data[idx] = 1000 + 10 * (rho * signal + np.sqrt(1 - rho ** 2) * noise)
+
+    nib.Nifti1Image(data.reshape(tuple(shape) + (n_timepoints,)), affine).to_filename(path)
+    return path
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux
+
+
+def _stage(name, run_path, work_dir, n_subjects, n_perm):
+    """Runs one stage in the current (fresh) process and returns its measurements."""
+    rss_before = _peak_rss_bytes()
+    extra = {}
+    start = time.perf_counter()
+
+    if name == "fc_extraction":
+        from fc_engine import stream_seed_maps
+        from nifti_reader import open_image
+
+        img = open_image(run_path, cache_dir=os.path.join(work_dir, "cache"))
+        voxels = seeds_in_grid(img.affine, img.shape)
+        maps = dict(zip(voxels, stream_seed_maps(img, list(voxels.values()))))
+        n_voxels = int(np.prod(img.shape[:3]))
+        # Planted check: FC of the mPFC seed with the PCC seed voxel should be near rho ** 2
+        if "mPFC" in maps and "PCC" in maps:
+            extra["planted_fc_mPFC_PCC"] = round(float(maps["mPFC"][voxels["PCC"]]), 3)
+            extra["planted_fc_recovered"] = extra["planted_fc_mPFC_PCC"] >= min_planted_fc
+
+    elif name == "sdbold":
+        from generate_sdbold_maps import compute_sdbold
+
+        compute_sdbold("bench", run_path, os.path.join(work_dir, "bench_sdbold.nii.gz"),
+                       detrend=True, cache_dir=os.path.join(work_dir, "cache"))
+        n_voxels = int(np.prod(nib.load(run_path).shape[:3]))
+
+    elif name == "roi_extraction":
+        from roi_extract import roi_stats, sphere_indices
+
+        img = nib.load(run_path)
+        data = np.asarray(img.dataobj[..., 0], dtype=np.float32)
+        seeds = {name: planted_seeds[name] for name in seeds_in_grid(img.affine, img.shape)}
+        for _ in range(n_subjects):
+            roi_stats(data, sphere_indices(seeds, 6, img.affine, img.shape), ("mean", "median", "std"))
+        n_voxels = data.size * n_subjects
+
+    elif name == "statistics":
+        from mass_stats import StreamingCorrelation, correlate, correlation_pvalues
+        from permutation import permutation_test_groups
+
+        rng = np.random.default_rng(0)
+        features = rng.normal(size=(n_subjects, 400))
+        scores = rng.normal(size=(n_subjects, 15))
+        r, n = correlate(features, scores)
+        correlation_pvalues(r, n)
+        permutation_test_groups(features[:, :13], np.arange(n_subjects) < n_subjects // 2, n_perm=n_perm, seed=0)
+
+        img = nib.load(run_path)
+        n_map_voxels = int(np.prod(img.shape[:3]))
+        accumulator = StreamingCorrelation(n_map_voxels, 2)
+        for subject in range(n_subjects):
+            accumulator.update(rng.normal(size=n_map_voxels), scores[subject, :2])
+        accumulator.result()
+        n_voxels = n_map_voxels * n_subjects
+
+    elif name == "prefetch":
+        import threading
+        from prefetch import prefetch
+
+        # Loads of one map each; the bytes loaded but not yet processed must stay within the budget
+        # (one subject ahead is always allowed, so the bound is the larger of the budget and two maps)
+        item_bytes = int(np.prod(nib.load(run_path).shape[:3])) * 8
+        budget_mb = 3.5 * item_bytes / 1024 ** 2
+        lock = threading.Lock()
+        held = [0, 0]  # current, peak
+
+        def load(i):
+            time.sleep(0.01)
+            with lock:
+                held[0] += item_bytes
+                held[1] = max(held[1], held[0])
+            return np.full(item_bytes // 8, i, dtype=np.float64)
+
+        for _, loaded, _ in prefetch(range(n_subjects), load, depth=8, max_memory_mb=budget_mb):
+            time.sleep(0.02)
+            with lock:
+                held[0] -= loaded.nbytes
+        extra["prefetch_peak_mb"] = round(held[1] / 1024 ** 2, 1)
+        extra["prefetch_within_budget"] = held[1] <= max(budget_mb * 1024 ** 2, 2 * item_bytes)
+        n_voxels = item_bytes // 8 * n_subjects
+
+    else:
+        raise ValueError(f"Unknown stage: {name}")
+
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": round(seconds, 4),
+        "peak_rss_mb": round(_peak_rss_bytes() / 1024 ** 2, 1),
+        "rss_before_mb": round(rss_before / 1024 ** 2, 1),
+        "voxels_per_second": round(n_voxels / seconds) if seconds > 0 else None,
+        **extra,
+    }
+
+
+def run_benchmarks(stages, run_path, work_dir, n_subjects, n_perm, repeats):
+    results = {}
+    spawn = multiprocessing.get_context("spawn")
+    for name in stages:
+        best = None
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(_stage, name, run_path, work_dir, n_subjects, n_perm).result()
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        results[name] = best
+        print(f"⏱️ {name}: {best['seconds']:.3f} s, peak RSS {best['peak_rss_mb']} MB, "
+              f"{best['voxels_per_second']} voxels/s")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the stages that got slower than baseline by more than tolerance (fraction)."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old and result["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append(f"{name}: {old['seconds']:.3f} s -> {result['seconds']:.3f} s")
+        if old and result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {old['peak_rss_mb']} MB -> {result['peak_rss_mb']} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark suite on synthetic fMRI data")
+    parser.add_argument("--shape", default="64,64,40", help="grid size x,y,z")
+    parser.add_argument("--timepoints", type=int, default=200)
+    parser.add_argument("--voxel-size", type=float, default=3.0, help="in mm")
+    parser.add_argument("--subjects", type=int, default=40, help="subjects simulated for the ROI and statistics stages")
+    parser.add_argument("--n-perm", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=1, help="runs per stage, the fastest is kept")
+    parser.add_argument("--stages", default="fc_extraction,sdbold,roi_extraction,statistics,prefetch")
+    parser.add_argument("--save", default=None, help="write results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    shape = tuple(int(v) for v in args.shape.split(","))
+    planted = seeds_in_grid(mni_affine(shape, args.voxel_size), shape)
+    if not planted:
+        parser.error(f"--shape {args.shape} at {args.voxel_size} mm leaves no planted seed inside the grid "
+                     f"(the default 64,64,40 holds all {len(planted_seeds)}; use a larger grid or --voxel-size)")
+    if not {"mPFC", "PCC"} <= set(planted):
+        print(f"⚠️ Only {', '.join(planted)} fall inside the grid; the planted mPFC-PCC check is skipped")
+    config = {"shape": shape, "timepoints": args.timepoints, "voxel_size": args.voxel_size,
+              "subjects": args.subjects, "n_perm": args.n_perm}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        run_path = os.path.join(work_dir, "sub-bench_task-rest_mc.nii.gz")
+        print(f"🔄 Generating synthetic run {shape} x {args.timepoints}...")
+        # In a child process too: on Linux the stage processes inherit the parent's peak RSS
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pool.submit(make_synthetic_run, run_path, shape, args.timepoints, args.voxel_size).result()
+        results = run_benchmarks(args.stages.split(","), run_path, work_dir, args.subjects, args.n_perm, args.repeats)
+
+    report = {"config": config, "machine": platform.platform(), "python": platform.python_version(),
+              "numpy": np.__version__, "results": results}
+
+    # The prefetch stage fails when more was held ahead than --prefetch-memory-mb allows
+    if results.get("prefetch", {}).get("prefetch_within_budget") is False:
+        print(f"❌ Prefetching held {results['prefetch']['prefetch_peak_mb']} MB, more than its memory budget")
+        sys.exit(1)
+
+    # Extraction that no longer finds the planted mPFC-PCC correlation is wrong, however fast it is
+    if results.get("fc_extraction", {}).get("planted_fc_recovered") is False:
+        print(f"❌ Planted mPFC-PCC FC recovered as {results['fc_extraction']['planted_fc_mPFC_PCC']}, "
+              f"expected about {planted_rho ** 2:.2f} (at least {min_planted_fc:.2f})")
+        sys.exit(1)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Baseline saved to: {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != json.loads(json.dumps(config)):
+            print("⚠️ Baseline was recorded with a different configuration")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ Regression: {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ No regressions against baseline")
@@ -0,0 +1,105 @@
+"""
+Batched bootstrap confidence intervals (percentile and BCa) for every feature x score Pearson correlation.
+Author: Emre Pelzer
+"""
+
+import warnings
+import numpy as np
+from scipy.stats import norm
+
+from mass_stats import correlate
+
+
+def add_bootstrap_arguments(parser):
+    """Adds the shared --bootstrap / --ci-level / --boot-seed / --boot-memory-mb options to a script's parser."""
+    parser.add_argument("--bootstrap", type=int, default=0, help="number of subject resamples for confidence intervals (0 = off)")
+    parser.add_argument("--ci-level", type=float, default=0.95, help="confidence level of the intervals")
+    parser.add_argument("--boot-seed", type=int, default=0, help="random seed, so intervals are reproducible")
+    parser.add_argument("--boot-memory-mb", type=int, default=512, help="memory budget for the resampled correlations")
+
+
+def bootstrap_indices(n, n_boot, seed=None):
+    """Matrix of n_boot resamples (with replacement) of range(n), one resample per row -> (n_boot, n)."""
+    return np.random.default_rng(seed).integers(0, n, size=(n_boot, n))
+
+
+def jackknife_indices(n):
+    """Leave-one-out subsets of range(n), one per row -> (n, n - 1)."""
+    return np.array([np.delete(np.arange(n), i) for i in range(n)])
+
+
+def _batched_correlations(X, Y, indices, chunk_size):
+    """correlate() for every row subset in indices, a chunk of subsets per batched call -> (len(indices), p, q)."""
+    r = np.empty((len(indices), X.shape[1], Y.shape[1]), dtype=np.float32)
+    for start in range(0, len(indices), chunk_size):
+        chunk = indices[start:start + chunk_size]
+        r[start:start + len(chunk)], _ = correlate(X[chunk], Y[chunk])
+    return r
+
+
+def _sorted_quantiles(sorted_values, n_finite, probs):
+    """Linear-interpolated quantiles per column of sorted_values (NaNs last); probs has one level per column."""
+    position = probs * np.maximum(n_finite - 1, 0)
+    lo = np.floor(position).astype(int)
+    hi = np.minimum(lo + 1, np.maximum(n_finite - 1, 0))
+    low_values = np.take_along_axis(sorted_values, lo[None], axis=0)[0]
+    high_values = np.take_along_axis(sorted_values, hi[None], axis=0)[0]
+    result = low_values + (position - lo) * (high_values - low_values)
+    return np.where(n_finite > 0, result, np.nan)
+
+
+def bootstrap_correlations(X, Y, n_boot=5000, seed=None, level=0.95, max_memory_mb=512):
+    """
+    Bootstrap confidence intervals of Pearson r for every column pair of X (n, p) and Y (n, q).
+    Subjects are resampled n_boot times as one index array; each chunk of resamples is correlated in one
+    batched call. Features are processed in blocks so the resampled r values stay within max_memory_mb.
+    Returns (r, ci_percentile, ci_bca): r is (p, q), the intervals are (2, p, q) with lower and upper bounds.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    n, p = X.shape
+    q = Y.shape[1]
+    r_obs, _ = correlate(X, Y)
+
+    indices = bootstrap_indices(n, n_boot, seed)
+    jackknife = jackknife_indices(n)
+    alpha = (1 - level) / 2
+    z_alpha = norm.ppf([alpha, 1 - alpha])[:, None, None]
+
+    # Budget: the float32 resampled r values of one feature block, plus the float64 temporaries of one batched call
+    budget = max_memory_mb * 1024 ** 2
+    block = int(max(1, min(p, budget // 2 // max(1, n_boot * q * 4))))
+    chunk_size = int(max(1, (budget // 2) // max(1, 8 * 8 * n * (block + q + block * q))))
+
+    ci_percentile = np.full((2, p, q), np.nan)
+    ci_bca = np.full((2, p, q), np.nan)
+    for f0 in range(0, p, block):
+        f1 = min(f0 + block, p)
+        Xb = X[:, f0:f1]
+        r_boot = _batched_correlations(Xb, Y, indices, chunk_size)
+        n_finite = np.isfinite(r_boot).sum(axis=0)
+        r_boot.sort(axis=0)  # NaNs (degenerate resamples) sort last and are ignored
+        obs = r_obs[f0:f1]
+
+        for k, prob in enumerate((alpha, 1 - alpha)):
+            ci_percentile[k, f0:f1] = _sorted_quantiles(r_boot, n_finite, np.full(obs.shape, prob))
+
+        # BCa: bias from the share of resamples below the estimate, acceleration from the jackknife
+        below = (np.nan_to_num(r_boot, nan=np.inf) < obs).sum(axis=0) + 0.5 * (r_boot == obs).sum(axis=0)
+        share = np.clip(below / np.maximum(n_finite, 1), 1 / (n_boot + 1), 1 - 1 / (n_boot + 1))
+        z0 = norm.ppf(share)
+
+        r_jack = _batched_correlations(Xb, Y, jackknife, chunk_size).astype(np.float64)
+        with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+            warnings.simplefilter("ignore", RuntimeWarning)  # pairs without any valid leave-one-out r
+            deviation = np.nanmean(r_jack, axis=0) - r_jack
+            accel = np.nansum(deviation ** 3, axis=0) / (6 * np.nansum(deviation ** 2, axis=0) ** 1.5)
+        accel = np.nan_to_num(accel)
+        probs = norm.cdf(z0 + (z0 + z_alpha) / (1 - accel * (z0 + z_alpha)))
+        for k in range(2):
+            ci_bca[k, f0:f1] = _sorted_quantiles(r_boot, n_finite, probs[k])
+
+    missing = np.isnan(r_obs)
+    ci_percentile[:, missing] = np.nan
+    ci_bca[:, missing] = np.nan
+    return r_obs, ci_percentile, ci_bca
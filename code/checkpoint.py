@@ -0,0 +1,127 @@
+"""
+Atomic per-subject / per-seed checkpoints and a timing manifest, so long extraction runs can be resumed.
+Author: Emre Pelzer
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import numpy as np
+
+
+def atomic_save_npy(path, array):
+    """Writes to a temporary file first and renames it, so a crash never leaves a half-written .npy."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def input_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def local_sources(path, seen=None):
+    """Absolute paths of a script plus every module next to it that it imports (recursively)."""
+    seen = seen if seen is not None else set()
+    path = os.path.abspath(path)
+    if path in seen:
+        return seen
+    seen.add(path)
+    with open(path) as f:
+        source = f.read()
+    for module in re.findall(r"^\s*(?:from|import)\s+(\w+)", source, flags=re.MULTILINE):
+        module_path = os.path.join(os.path.dirname(path), f"{module}.py")
+        if os.path.exists(module_path):
+            local_sources(module_path, seen)
+    return seen
+
+
+def code_version(*paths):
+    """
+    Short hash of source files and the local modules they import, stored with the checkpoints so code changes
+    invalidate them (the same files run_pipeline.py hashes for a stage).
+    """
+    sources = set()
+    for path in paths:
+        local_sources(path, sources)
+    digest = hashlib.sha1()
+    for path in sorted(sources):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class Checkpoint:
+    """
+    Layout of checkpoint_dir:
+        <subject>/<seed>.npy   finished seed maps not yet moved into the feature store
+        manifest.json          subjects moved into the store, with input fingerprint and timings
+    Entries only count when the run parameters (e.g. seed coordinates) and the input file are unchanged.
+    """
+
+    def __init__(self, checkpoint_dir, params, resume=True):
+        self.dir = checkpoint_dir
+        self.params = params
+        self.manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.manifest = {"params": params, "subjects": {}}
+        if resume and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("params") == params:
+                self.manifest = manifest
+            else:
+                print("⚠️ Parameters changed since the last run, checkpoints are ignored")
+                resume = False
+        if not resume:
+            for entry in os.listdir(checkpoint_dir):
+                if os.path.isdir(os.path.join(checkpoint_dir, entry)):
+                    shutil.rmtree(os.path.join(checkpoint_dir, entry))
+
+    def is_done(self, subject, img_path, stored_seeds):
+        """True if the subject was finished from this input and stored_seeds (the store's seeds) holds its maps."""
+        entry = self.manifest["subjects"].get(subject)
+        return (entry is not None and entry["input"] == input_fingerprint(img_path)
+                and set(entry["seeds"]) <= set(stored_seeds))
+
+    def subject_dir(self, subject):
+        return os.path.join(self.dir, subject)
+
+    def finished_seeds(self, subject):
+        """Seeds whose maps were checkpointed by a previous (possibly interrupted) attempt."""
+        subject_dir = self.subject_dir(subject)
+        if not os.path.isdir(subject_dir):
+            return []
+        return sorted(f[:-4] for f in os.listdir(subject_dir) if f.endswith(".npy"))
+
+    def save_seed(self, subject, seed, fc_map):
+        os.makedirs(self.subject_dir(subject), exist_ok=True)
+        atomic_save_npy(os.path.join(self.subject_dir(subject), f"{seed}.npy"), fc_map)
+
+    def load_seed(self, subject, seed):
+        return np.load(os.path.join(self.subject_dir(subject), f"{seed}.npy"))
+
+    def mark_done(self, subject, img_path, seeds, skipped, seconds):
+        """Records a subject as complete (after its maps are in the store) and drops its seed files."""
+        self.manifest["subjects"][subject] = {
+            "input": input_fingerprint(img_path),
+            "seeds": seeds,
+            "skipped": skipped,
+            "seconds": round(seconds, 2),
+            "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        atomic_write_json(self.manifest_path, self.manifest)
+        shutil.rmtree(self.subject_dir(subject), ignore_errors=True)
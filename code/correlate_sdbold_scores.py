@@ -3,92 +3,117 @@ Analyzes correlation between SD-BOLD variability and cognitive scores (CVLT1, SE
 Author: Emre Pelzer
 """
 
+import argparse
 import os
 import pandas as pd
-import numpy as np
 import nibabel as nib
-from nilearn.input_data import NiftiSpheresMasker
-from scipy.stats import pearsonr
+
+from bootstrap import add_bootstrap_arguments, bootstrap_correlations
+from manifest import Manifest
+from mass_stats import correlation_table
+from permutation import add_permutation_arguments, permutation_test_correlations
+from profiling import add_profile_argument, enable, stage
+from roi_extract import parcel_stats, roi_stats, sphere_indices_for
+from seed_registry import add_region_arguments, load_atlas, radius, seeds
+from subject_pool import add_pool_arguments, run_subjects
 
 sdbold_dir = "features_sdbold"
 scores_file = "cognitive_scores_normalized.csv"
+roi_output = "sdbold_roi_values.csv"
+output_csv = "sdbold_correlation_results.csv"
+
 
-# Seed coordinates (same as in extraction)
-seeds = {
-    "mPFC": [1, 55, -3],
-    "PCC": [1, -61, 38],
-    "LP_left": [-39, -77, 33],
-    "LP_right": [47, -67, 29],
-    "ACC": [0, 22, 35],
-    "AINS_left": [-44, 13, 1],
-    "AINS_right": [47, 14, 0],
-    "RPFC_left": [-32, 45, 27],
-    "RPFC_right": [32, 46, 27],
-    "SMG_left": [-60, -39, 31],
-    "SMG_right": [62, -35, 32],
-    "Hippocampus_left": [-24, -18, -20],
-    "Hippocampus_right": [24, -18, -20]
-}
-
-scores_df = pd.read_csv(scores_file)
-subjects = scores_df["subject"].tolist()
-cog_scores = scores_df.drop(columns=["subject"])
-
-# Prepare matrix to store SD-BOLD values per seed
-sdbold_values = {seed: [] for seed in seeds}
-valid_subjects = []
-
-# Extract mean SD-BOLD per seed
-for subject in subjects:
-    print(f"🔄 Processing {subject}...")
-    filepath = os.path.join(sdbold_dir, f"{subject}_sdbold.nii.gz")
-    if not os.path.exists(filepath):
-        print(f"⚠️ Missing file: {filepath}")
-        continue
-
-    try:
+def extract_subject(subject, filepath, stats=("mean",), labels=None, names=None):
+    """
+    Returns {region: {stat: value}} of SD-BOLD inside every seed sphere for one subject, or inside every
+    parcel when labels (flat atlas label per voxel on this subject's grid) and names {label: name} are given.
+    """
+    with stage("load"):
         img = nib.load(filepath)
-    except Exception as e:
-        print(f"❌ Failed to load {filepath}: {e}")
-        continue
-
-    valid_subjects.append(subject)
-
-    for name, coord in seeds.items():
-        masker = NiftiSpheresMasker([coord], radius=6, detrend=False, standardize=False)
-        try:
-            ts = masker.fit_transform(img)
-            mean_val = np.mean(ts)
-        except Exception as e:
-            print(f"❌ Failed masker for {subject} at {name}: {e}")
-            mean_val = np.nan
-        sdbold_values[name].append(mean_val)
-
-sdbold_df = pd.DataFrame(sdbold_values)
-sdbold_df.insert(0, "subject", valid_subjects)
-
-merged = pd.merge(sdbold_df, scores_df, on="subject")
-
-# Correlations
-correlation_results = []
-for seed in seeds:
-    for score in cog_scores.columns:
-        x = merged[seed]
-        y = merged[score]
-        if x.isnull().any() or y.isnull().any():
-            corr = np.nan
-            pval = np.nan
+    with stage("read"):
+        data = img.get_fdata()
+
+    if labels is not None:
+        with stage("roi"):
+            return parcel_stats(data, labels, names, stats)
+
+    # Sphere voxels are computed once per image grid and all seeds are reduced in one pass
+    indices = sphere_indices_for(img, seeds, radius)
+    for name, idx in indices.items():
+        if len(idx) == 0:
+            print(f"❌ Seed {name} lies outside the image for {subject}")
+    with stage("roi"):
+        return roi_stats(data, indices, stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SD-BOLD vs cognition correlations")
+    parser.add_argument("--stats", default="mean", help="comma-separated ROI statistics: mean, median, std")
+    add_pool_arguments(parser)
+    add_region_arguments(parser)
+    add_permutation_arguments(parser, default_n_perm=0)
+    add_bootstrap_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+    atlas = load_atlas(args)
+    regions = atlas.region_names() if atlas else list(seeds)
+    stats = tuple(args.stats.split(","))
+    if "mean" not in stats:
+        stats = ("mean",) + stats
+
+    manifest = Manifest(scores_file, kinds=["sdbold"], dirs={"sdbold": sdbold_dir})
+    scores_df = manifest.scores.reset_index()
+    subjects = scores_df["subject"].tolist()
+    cog_scores = scores_df.drop(columns=["subject"])
+
+    # Extract mean SD-BOLD per seed
+    tasks = []
+    for subject in subjects:
+        filepath = manifest.path("sdbold", subject)
+        if filepath is None:
+            print(f"⚠️ Missing file: {os.path.join(sdbold_dir, f'{subject}_sdbold.nii.gz')}")
+            continue
+        if atlas:
+            # Labels are resampled once per grid here, so workers only reduce
+            tasks.append((subject, (subject, filepath, stats, atlas.labels_on(nib.load(filepath)), atlas.names)))
         else:
-            corr, pval = pearsonr(x, y)
-        correlation_results.append({
-            "seed": seed,
-            "score": score,
-            "correlation": corr,
-            "p_value": pval
-        })
-
-results_df = pd.DataFrame(correlation_results)
-
-output_path = os.path.join(os.path.dirname(__file__), "sdbold_correlation_results.csv")
-results_df.to_csv(output_path, index=False)
-print("✅ Correlations saved to:", output_path)
+            tasks.append((subject, (subject, filepath, stats)))
+
+    print(f"🔄 Processing {len(tasks)} subjects...")
+    sdbold_values, _ = run_subjects(extract_subject, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb)
+
+    # Tidy subject x seed table with one column per statistic
+    roi_df = pd.DataFrame([
+        {"subject": subject, "seed": seed, **values[seed]}
+        for subject, values in sdbold_values.items() for seed in regions
+    ])
+    roi_df.to_csv(roi_output, index=False)
+    print(f"✅ ROI values saved to: {roi_output}")
+
+    sdbold_df = roi_df.pivot(index="subject", columns="seed", values="mean").reindex(columns=regions).reset_index()
+
+    merged = pd.merge(sdbold_df, scores_df, on="subject")
+
+    with stage("statistics"):
+        # All seed x score correlations at once
+        results_df = correlation_table(merged[regions], merged[cog_scores.columns],
+                                       r_col="correlation", p_col="p_value")
+
+        # Optional permutation p-values, FWE-corrected with the max |r| over all seed x score pairs
+        if args.n_perm > 0:
+            _, p_perm, p_fwe = permutation_test_correlations(merged[regions], merged[cog_scores.columns],
+                                                             n_perm=args.n_perm, seed=args.perm_seed)
+            results_df["p_perm"] = p_perm.ravel()
+            results_df["p_perm_fwe"] = p_fwe.ravel()
+
+        # Optional bootstrap confidence intervals of r (percentile and BCa)
+        if args.bootstrap > 0:
+            _, ci, ci_bca = bootstrap_correlations(merged[regions], merged[cog_scores.columns],
+                                                   n_boot=args.bootstrap, seed=args.boot_seed, level=args.ci_level,
+                                                   max_memory_mb=args.boot_memory_mb)
+            results_df["ci_low"], results_df["ci_high"] = ci[0].ravel(), ci[1].ravel()
+            results_df["bca_low"], results_df["bca_high"] = ci_bca[0].ravel(), ci_bca[1].ravel()
+
+    results_df.to_csv(output_csv, index=False)
+    print("✅ Correlations saved to:", output_csv)
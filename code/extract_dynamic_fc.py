@@ -0,0 +1,143 @@
+"""
+Sliding-window dynamic FC: region-to-region (and optionally seed-to-voxel) correlations per window,
+summarized per subject as the mean and the variability (SD) of Fisher z FC over windows.
+Author: Emre Pelzer
+"""
+
+import argparse
+import warnings
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from extract_roi_connectivity import region_timeseries
+from fc_engine import edge_names, sliding_window_fc, upper_triangle
+from feature_store import FeatureStore
+from manifest import layouts, scan
+from nifti_reader import add_cache_arguments, apply_cache_arguments, iter_slabs, open_image
+from profiling import add_profile_argument, enable, stage
+from seed_registry import add_region_arguments, load_atlas, seeds
+from subject_pool import add_pool_arguments, run_subjects
+
+preproc_dir = "preprocessed"
+store_path = "features_fc.h5"
+voxel_store_path = "features_dfc.h5"
+output_csv = "fc_dynamic.csv"
+window = 30  # in volumes
+step = 1
+
+
+def window_summary(windows):
+    """Mean and SD (ddof=1) over windows of an iterable of same-shaped arrays, accumulated one window at a time."""
+    count = total = total_sq = None
+    for values in windows:
+        finite = np.isfinite(values)
+        values = np.where(finite, values, 0.0)
+        if total is None:
+            count, total, total_sq = np.zeros(values.shape), np.zeros(values.shape), np.zeros(values.shape)
+        count += finite
+        total += values
+        total_sq += values ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+        sd = np.where(count > 1, np.sqrt(np.maximum(total_sq - count * mean ** 2, 0) / (count - 1)), np.nan)
+    return mean, sd
+
+
+def subject_dynamic_fc(subject_id, img_path, window=window, step=step, cache_dir=None, max_chunk_mb=256,
+                       labels=None, parcels=None, voxelwise=False):
+    """
+    Returns (edge means, edge SDs, n_windows, sd_maps, affine) for one subject. sd_maps (n_regions, x, y, z)
+    holds the SD over windows of every region's seed-to-voxel FC, or is None unless voxelwise is set.
+    """
+    img = open_image(img_path, cache_dir)
+    ts = region_timeseries(subject_id, img, max_chunk_mb, labels, parcels)
+    n_windows = len(range(0, ts.shape[1] - window + 1, step))
+
+    with warnings.catch_warnings(), stage("correlation"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean, sd = window_summary(upper_triangle(r) for _, r in sliding_window_fc(ts, ts, window, step))
+
+    sd_maps = None
+    if voxelwise:
+        # Each z-slab holds all timepoints, so the windows run slab by slab with only one slab in memory
+        x, y, z = img.shape[:3]
+        sd_maps = np.zeros((len(ts), x, y, z), dtype=np.float32)
+        seed_ts = np.nan_to_num(ts)
+        for z0, z1, slab in iter_slabs(img, max_chunk_mb=max_chunk_mb):
+            with stage("correlation"):
+                windows = (r for _, r in sliding_window_fc(seed_ts, slab.reshape(-1, slab.shape[-1]), window, step))
+                _, slab_sd = window_summary(windows)
+                sd_maps[..., z0:z1] = np.nan_to_num(slab_sd).reshape(len(ts), x, y, z1 - z0)
+
+    return mean.astype(np.float32), sd.astype(np.float32), n_windows, sd_maps, img.affine
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sliding-window dynamic FC summaries")
+    parser.add_argument("--preproc-dir", default=preproc_dir)
+    parser.add_argument("--window", type=int, default=window, help="window length in volumes")
+    parser.add_argument("--step", type=int, default=step, help="volumes the window advances each time")
+    parser.add_argument("--store", default=store_path, help="HDF5 feature store the edge summaries are written to")
+    parser.add_argument("--output", default=output_csv, help="wide CSV: subject + <edge>_mean / <edge>_sd columns")
+    parser.add_argument("--voxelwise", action="store_true", help="also compute seed-to-voxel FC variability maps")
+    parser.add_argument("--voxel-store", default=voxel_store_path, help="HDF5 store for the --voxelwise maps")
+    add_cache_arguments(parser)
+    parser.add_argument("--chunk-mb", type=int, default=256, help="size of the blocks read at a time")
+    add_region_arguments(parser)
+    add_pool_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+    apply_cache_arguments(args)
+    atlas = load_atlas(args)
+    regions = atlas.region_names() if atlas else list(seeds)
+
+    tasks = []
+    for subject_id, img_path in scan(args.preproc_dir, layouts["run"][1]).items():
+        task = (subject_id, img_path, args.window, args.step, args.cache_dir, args.chunk_mb)
+        if atlas:
+            task += (atlas.labels_on(nib.load(img_path)), sorted(atlas.names))
+        else:
+            task += (None, None)
+        tasks.append((subject_id, task + (args.voxelwise,)))
+
+    # Voxel maps go to their own store as soon as a subject finishes; only the edge summaries are kept
+    voxel_store = FeatureStore(args.voxel_store) if args.voxelwise else None
+
+    def keep_summaries(subject_id, result):
+        mean, sd, n_windows, sd_maps, affine = result
+        if voxel_store is not None:
+            with stage("merge", subject_id):
+                for region, sd_map in zip(regions, sd_maps):
+                    voxel_store.write_map(subject_id, region, sd_map, affine)
+                voxel_store.file.flush()
+        return mean, sd, n_windows
+
+    try:
+        results, _ = run_subjects(subject_dynamic_fc, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb,
+                                  on_result=keep_summaries)
+    finally:
+        if voxel_store is not None:
+            voxel_store.close()
+    if not results:
+        raise SystemExit("❌ No subjects processed")
+
+    subjects = list(results)
+    edges = edge_names(regions)
+    means = np.vstack([results[s][0] for s in subjects])
+    sds = np.vstack([results[s][1] for s in subjects])
+
+    with stage("save"):
+        with FeatureStore(args.store) as store:
+            for name, values in (("dynamic_mean", means), ("dynamic_sd", sds)):
+                store.write_edges(name, subjects, edges, values, window=args.window, step=args.step)
+        table = pd.concat([pd.DataFrame(sds, columns=[f"{e}_sd" for e in edges]),
+                           pd.DataFrame(means, columns=[f"{e}_mean" for e in edges])], axis=1)
+        table.insert(0, "subject", subjects)
+        table.to_csv(args.output, index=False)
+
+    print(f"✅ Dynamic FC ({results[subjects[0]][2]} windows of {args.window} volumes) for {len(subjects)} subjects "
+          f"saved to: {args.output} and {args.store} (edges/dynamic_mean, edges/dynamic_sd)")
+    if args.voxelwise:
+        print(f"✅ FC variability maps saved to: {args.voxel_store}")
@@ -3,82 +3,139 @@ Performs seed-based FC extraction by computing correlation maps from fMRI and se
 Author: Emre Pelzer
 """
 
+import argparse
 import json
 import os
-import nibabel as nib
+import time
 import numpy as np
-from nilearn.input_data import NiftiSpheresMasker
 from nilearn.image import coord_transform
 
-# List of seed regions with MNI coordinates from Krönke et al. (2020)
-seeds = {
-    "mPFC": [1, 55, -3],
-    "PCC": [1, -61, 38],
-    "LP_left": [-39, -77, 33],
-    "LP_right": [47, -67, 29],
-    "ACC": [0, 22, 35],
-    "AINS_left": [-44, 13, 1],
-    "AINS_right": [47, 14, 0],
-    "RPFC_left": [-32, 45, 27],
-    "RPFC_right": [32, 46, 27],
-    "SMG_left": [-60, -39, 31],
-    "SMG_right": [62, -35, 32],
-    "Hippocampus_left": [-28, -6, -12],
-    "Hippocampus_right": [30, -8, -14],
-}
-
-output_path = os.path.join("datasets", "ds004796", "seed_coordinates.json")
-os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-with open(output_path, "w") as f:
-    json.dump(seeds, f, indent=4)
-
-print(f"Saved seed coordinates to: {output_path}")
+from checkpoint import Checkpoint, code_version
+from fc_engine import stream_seed_maps
+from feature_store import FeatureStore
+from manifest import layouts, scan
+from nifti_reader import add_cache_arguments, apply_cache_arguments, open_image, read_voxels, uncompressed_path
+from prefetch import add_prefetch_arguments
+from profiling import add_profile_argument, enable, stage
+from seed_registry import seeds
+from subject_pool import add_pool_arguments, run_subjects
 
 # Path to preprocessed data and output
 preproc_dir = "/Users/emrepelzer/Desktop/THESIS/datasets/ds004796/preprocessed"
-output_dir = "/Users/emrepelzer/Desktop/THESIS/datasets/ds004796/features_fc"
-os.makedirs(output_dir, exist_ok=True)
+store_path = "/Users/emrepelzer/Desktop/THESIS/datasets/ds004796/features_fc.h5"
 
 
-# List all subject files
-subject_files = [f for f in os.listdir(preproc_dir) if f.endswith("_mc.nii.gz")]
+def extract_subject(subject_id, img_path, checkpoint, fisher_z=False, cache_dir=None, max_chunk_mb=256):
+    """
+    Computes the seed FC maps of one subject that are not checkpointed yet and checkpoints each of them.
+    Returns (affine, skipped seeds, seconds).
+    """
+    start = time.perf_counter()
+    already_done = set(checkpoint.finished_seeds(subject_id))
 
-from nilearn.image import coord_transform
-
-for file in subject_files:
-    subject_id = file.split("_")[0]
-    img_path = os.path.join(preproc_dir, file)
-    img = nib.load(img_path)
+    # Data stays on disk; slabs are streamed in float32 instead of get_fdata() on the whole run
+    img = open_image(img_path, cache_dir)
     affine = img.affine
-
-    try:
-        full_data = img.get_fdata()
-        n_timepoints = full_data.shape[-1]
-
-        for seed_name, mni_coord in seed_coords.items():
-            voxel_coord = coord_transform(*mni_coord, np.linalg.inv(affine))
-            voxel_coord_rounded = tuple(np.round(voxel_coord).astype(int))
-
-            x, y, z = voxel_coord_rounded
-            if not (0 <= x < full_data.shape[0] and 0 <= y < full_data.shape[1] and 0 <= z < full_data.shape[2]):
-                print(f"⚠️ Skipped {subject_id} - {seed_name}: voxel out of bounds")
+    spatial_shape = img.shape[:3]
+
+    # Resolve seed voxels first, so all maps come out of one batched correlation
+    seed_names = []
+    seed_voxels = []
+    skipped = []
+    for seed_name, mni_coord in seeds.items():
+        if seed_name in already_done:
+            continue
+        voxel_coord = coord_transform(*mni_coord, np.linalg.inv(affine))
+        voxel_coord_rounded = tuple(np.round(voxel_coord).astype(int))
+
+        x, y, z = voxel_coord_rounded
+        if not (0 <= x < spatial_shape[0] and 0 <= y < spatial_shape[1] and 0 <= z < spatial_shape[2]):
+            print(f"⚠️ Skipped {subject_id} - {seed_name}: voxel out of bounds")
+            skipped.append(seed_name)
+            continue
+
+        seed_ts = read_voxels(img, [voxel_coord_rounded])[0]
+        if np.std(seed_ts) == 0:
+            print(f"⚠️ Skipped {subject_id} - {seed_name}: zero std in seed time series")
+            skipped.append(seed_name)
+            continue
+
+        seed_names.append(seed_name)
+        seed_voxels.append(voxel_coord_rounded)
+
+    if seed_names:
+        fc_maps = stream_seed_maps(img, seed_voxels, fisher=fisher_z, max_chunk_mb=max_chunk_mb)
+        with stage("save"):
+            for seed_name, fc_map in zip(seed_names, fc_maps):
+                checkpoint.save_seed(subject_id, seed_name, fc_map)
+    return affine, skipped, time.perf_counter() - start
+
+
+def decompress_run(subject_id, img_path, checkpoint, fisher_z=False, cache_dir=None, max_chunk_mb=256):
+    """I/O step run ahead of extract_subject: gunzips the run into the cache, where open_image then finds it."""
+    uncompressed_path(img_path, cache_dir)
+    return subject_id, img_path, checkpoint, fisher_z, cache_dir, max_chunk_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed-based FC extraction")
+    parser.add_argument("--fisher-z", action="store_true", help="save Fisher z-transformed maps instead of r")
+    parser.add_argument("--preproc-dir", default=preproc_dir)
+    parser.add_argument("--store", default=store_path, help="HDF5 feature store the maps are written to")
+    add_cache_arguments(parser)
+    parser.add_argument("--chunk-mb", type=int, default=256, help="size of the voxel slabs read at a time")
+    parser.add_argument("--checkpoint-dir", default=None, help="per-seed checkpoints and manifest (default: <store>.checkpoints)")
+    parser.add_argument("--no-resume", action="store_true", help="ignore checkpoints from earlier runs")
+    parser.add_argument("--subjects", default=None, help="comma-separated subject IDs to (re)process (default: all)")
+    add_pool_arguments(parser)
+    add_prefetch_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+    apply_cache_arguments(args)
+    only_subjects = set(args.subjects.split(",")) if args.subjects else None
+
+    output_path = os.path.join("datasets", "ds004796", "seed_coordinates.json")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    with open(output_path, "w") as f:
+        json.dump(seeds, f, indent=4)
+
+    print(f"Saved seed coordinates to: {output_path}")
+
+    # Finished subjects are skipped; interrupted ones resume with the seeds still missing
+    # (a change in seeds, options or extraction code invalidates them)
+    params = {"fisher_z": args.fisher_z, "seeds": seeds, "code": code_version(__file__)}
+    checkpoint = Checkpoint(args.checkpoint_dir or f"{args.store}.checkpoints", params, resume=not args.no_resume)
+
+    # List all subject files
+    runs = scan(args.preproc_dir, layouts["run"][1])
+
+    # Workers only compute; the main process is the single writer of the HDF5 store
+    with FeatureStore(args.store) as store:
+        # A subject only counts as extracted while its maps are still in this store
+        tasks = []
+        img_paths = {}
+        for subject_id, img_path in runs.items():
+            if only_subjects is not None and subject_id not in only_subjects:
                 continue
-
-            seed_ts = full_data[x, y, z, :]
-            if np.std(seed_ts) == 0:
-                print(f"⚠️ Skipped {subject_id} - {seed_name}: zero std in seed time series")
+            if checkpoint.is_done(subject_id, img_path, store.seeds(subject_id)):
+                print(f"⏭️ {subject_id} already extracted")
                 continue
-
-            all_vox_ts = full_data.reshape(-1, n_timepoints)
-            correlations = np.array([
-                np.corrcoef(seed_ts, voxel_ts)[0, 1] if np.std(voxel_ts) > 0 else 0
-                for voxel_ts in all_vox_ts
-            ])
-            fc_map = correlations.reshape(full_data.shape[:3])
-
-            output_path = os.path.join(output_dir, f"{subject_id}_{seed_name}_fc.npy")
-            np.save(output_path, fc_map)
-
-    except Exception as e:
-        print(f"❌ Error processing {subject_id}: {e}")
+            img_paths[subject_id] = img_path
+            tasks.append((subject_id, (subject_id, img_path, checkpoint, args.fisher_z, args.cache_dir, args.chunk_mb)))
+
+        def save_subject(subject_id, result):
+            affine, skipped, seconds = result
+            finished = checkpoint.finished_seeds(subject_id)
+            with stage("merge", subject_id):
+                for seed_name in finished:
+                    store.write_map(subject_id, seed_name, checkpoint.load_seed(subject_id, seed_name), affine)
+                store.file.flush()
+            checkpoint.mark_done(subject_id, img_paths[subject_id], finished, skipped, seconds)
+            return finished
+
+        run_subjects(extract_subject, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb,
+                     load=decompress_run, prefetch=args.prefetch, prefetch_memory_mb=args.prefetch_memory_mb,
+                     on_result=save_subject)
+    print(f"✅ FC maps saved to: {args.store}")
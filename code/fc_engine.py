@@ -0,0 +1,136 @@
+"""
+Vectorized seed-to-voxel correlation engine used for FC extraction.
+Author: Emre Pelzer
+"""
+
+import numpy as np
+
+from nifti_reader import iter_slabs, read_voxels
+from profiling import stage
+
+# Largest |r| kept before the Fisher transform (the seed voxel itself has r = 1)
+FISHER_CLIP = 1 - 1e-7
+
+
+def zscore_timeseries(ts, dtype=np.float64):
+    """Z-scores time series along the last axis. Zero-variance series become all zeros."""
+    ts = np.asarray(ts, dtype=dtype)
+    mean = ts.mean(axis=-1, keepdims=True)
+    std = ts.std(axis=-1, keepdims=True)
+    valid = std > 0
+    z = np.divide(ts - mean, std, out=np.zeros(ts.shape, dtype=dtype), where=valid)
+    return z, valid[..., 0]
+
+
+def fisher_z(r):
+    """Fisher r-to-z transform, clipped so perfect correlations stay finite."""
+    return np.arctanh(np.clip(r, -FISHER_CLIP, FISHER_CLIP))
+
+
+def correlate_seeds(seed_z, voxel_z, fisher=False):
+    """Correlates z-scored seed series (S, T) with z-scored voxel series (V, T) in one product -> (S, V)."""
+    n_timepoints = voxel_z.shape[-1]
+    r = seed_z @ voxel_z.T
+    r /= n_timepoints
+    np.clip(r, -1, 1, out=r)
+    return fisher_z(r) if fisher else r
+
+
+def seed_correlation_maps(data, seed_voxels, fisher=False, dtype=np.float64):
+    """
+    Computes one FC map per seed voxel from a 4D array (x, y, z, t).
+    Voxels with zero variance get correlation 0, like the per-voxel np.corrcoef loop did.
+    Returns an array of shape (n_seeds, x, y, z).
+    """
+    spatial_shape = data.shape[:3]
+    voxel_z, _ = zscore_timeseries(data.reshape(-1, data.shape[-1]), dtype=dtype)
+    seed_idx = np.ravel_multi_index(np.asarray(seed_voxels).T, spatial_shape)
+    maps = correlate_seeds(voxel_z[seed_idx], voxel_z, fisher=fisher)
+    return maps.reshape((len(seed_idx),) + spatial_shape)
+
+
+def stream_seed_maps(img, seed_voxels, fisher=False, max_chunk_mb=256):
+    """
+    Same as seed_correlation_maps, but reads the image in z-slabs (see nifti_reader.iter_slabs)
+    and works in float32, so only one slab of the 4D run is in memory at a time.
+    """
+    x, y, z = img.shape[:3]
+    seed_z, _ = zscore_timeseries(read_voxels(img, seed_voxels), dtype=np.float32)
+    maps = np.zeros((len(seed_voxels), x, y, z), dtype=np.float32)
+
+    for z0, z1, slab in iter_slabs(img, max_chunk_mb=max_chunk_mb):
+        with stage("correlation"):
+            voxel_z, _ = zscore_timeseries(slab.reshape(-1, slab.shape[-1]), dtype=np.float32)
+            maps[..., z0:z1] = correlate_seeds(seed_z, voxel_z, fisher=fisher).reshape(len(seed_voxels), x, y, z1 - z0)
+    return maps
+
+
+def connectivity_matrix(ts, fisher=True):
+    """
+    ROI-to-ROI correlation matrix of time series ts (R, T), Fisher z-transformed by default.
+    ROIs without a usable signal (NaN or zero variance) get NaN rows and columns; the diagonal is NaN.
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    finite = np.all(np.isfinite(ts), axis=-1)
+    z, valid = zscore_timeseries(np.where(finite[:, None], ts, 0.0))
+    valid &= finite
+
+    matrix = correlate_seeds(z, z, fisher=fisher)
+    matrix[~valid, :] = np.nan
+    matrix[:, ~valid] = np.nan
+    np.fill_diagonal(matrix, np.nan)
+    return matrix
+
+
+def edge_names(names):
+    """Names of the upper-triangle edges, in the order of upper_triangle: 'mPFC__PCC', ..."""
+    rows, cols = np.triu_indices(len(names), k=1)
+    return [f"{names[i]}__{names[j]}" for i, j in zip(rows, cols)]
+
+
+def upper_triangle(matrix):
+    """Edges above the diagonal of an (R, R) matrix as a flat vector of length R * (R - 1) / 2."""
+    return matrix[np.triu_indices(matrix.shape[0], k=1)]
+
+
+def sliding_window_fc(seed_ts, voxel_ts, window, step=1, fisher=True):
+    """
+    Yields (start, r) for every window of `window` timepoints, advanced by `step`: the correlation (S, V)
+    of seed_ts (S, T) with voxel_ts (V, T) inside the window. The window sums are kept as running totals
+    and only updated with the timepoints that enter and leave, instead of recomputing every window.
+    Series without variance inside a window give NaN.
+    """
+    x = np.asarray(seed_ts, dtype=np.float64)
+    y = np.asarray(voxel_ts, dtype=np.float64)
+    # Centering on the run mean keeps the running sums small, so adding and subtracting stays exact enough
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    n_timepoints = x.shape[-1]
+    if window < 3 or window > n_timepoints:
+        raise ValueError(f"Window of {window} timepoints does not fit a run of {n_timepoints}")
+
+    first = slice(0, window)
+    sx, sy = x[:, first].sum(axis=1), y[:, first].sum(axis=1)
+    sxx, syy = (x[:, first] ** 2).sum(axis=1), (y[:, first] ** 2).sum(axis=1)
+    sxy = x[:, first] @ y[:, first].T
+
+    previous = 0
+    for start in range(0, n_timepoints - window + 1, step):
+        if start > 0:
+            leave = slice(previous, min(start, previous + window))
+            enter = slice(max(start, previous + window), start + window)
+            for part, sign in ((enter, 1), (leave, -1)):
+                xs, ys = x[:, part], y[:, part]
+                sx += sign * xs.sum(axis=1)
+                sy += sign * ys.sum(axis=1)
+                sxx += sign * (xs ** 2).sum(axis=1)
+                syy += sign * (ys ** 2).sum(axis=1)
+                sxy += sign * (xs @ ys.T)
+        previous = start
+
+        cov = sxy - np.outer(sx, sy) / window
+        var = np.outer(sxx - sx ** 2 / window, syy - sy ** 2 / window)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = np.where(var > 1e-12 * np.outer(sxx, syy), cov / np.sqrt(np.abs(var)), np.nan)
+        r = np.clip(r, -1, 1)
+        yield start, fisher_z(r) if fisher else r
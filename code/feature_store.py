@@ -0,0 +1,176 @@
+"""
+Chunked, compressed HDF5 store for FC maps, indexed by subject and seed, with a per-map summary table.
+Author: Emre Pelzer
+
+Layout:
+    maps/<subject>/<seed>   float32 voxel map (gzip, chunked), affine stored as an attribute
+    summary/subject, summary/seed, summary/<column>   one row per map, e.g. mean_fc
+    edges/<name>/values, edges/<name>/subject, edges/<name>/edge   cohort subjects x edges matrix (e.g. ROI-to-ROI FC)
+"""
+
+import argparse
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+from seed_registry import seeds
+
+default_store = "features_fc.h5"
+
+
+def summarize_map(fc_map):
+    """Scalar summaries kept next to every map so analyses don't have to load the voxels."""
+    finite = fc_map[np.isfinite(fc_map)]
+    brain = finite[finite != 0]  # voxels without signal have FC exactly 0
+    return {
+        "mean_fc": float(np.mean(finite)) if finite.size else np.nan,
+        "mean_fc_brain": float(np.mean(brain)) if brain.size else np.nan,
+    }
+
+
+class FeatureStore:
+    """FC feature store backed by one HDF5 file. Only one process should write at a time."""
+
+    def __init__(self, path=default_store, mode="a"):
+        self.path = path
+        self.file = h5py.File(path, mode)
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    # Voxel maps
+
+    def write_map(self, subject, seed, fc_map, affine=None):
+        """Stores (or replaces) one FC map and updates its summary row."""
+        fc_map = np.asarray(fc_map, dtype=np.float32)
+        group = self.file.require_group(f"maps/{subject}")
+        if seed in group:
+            del group[seed]
+        dataset = group.create_dataset(seed, data=fc_map, chunks=True, compression="gzip",
+                                       compression_opts=4, shuffle=True)
+        if affine is not None:
+            dataset.attrs["affine"] = np.asarray(affine, dtype=np.float64)
+        self.write_summary(subject, seed, summarize_map(fc_map))
+
+    def read_map(self, subject, seed):
+        return self.file[f"maps/{subject}/{seed}"][()]
+
+    def read_affine(self, subject, seed):
+        return self.file[f"maps/{subject}/{seed}"].attrs.get("affine")
+
+    def has_map(self, subject, seed):
+        return f"maps/{subject}/{seed}" in self.file
+
+    def subjects(self):
+        return sorted(self.file["maps"].keys()) if "maps" in self.file else []
+
+    def seeds(self, subject):
+        return sorted(self.file[f"maps/{subject}"].keys()) if f"maps/{subject}" in self.file else []
+
+    # Summary table
+
+    def _table(self):
+        table = self.file.require_group("summary")
+        for key in ("subject", "seed"):
+            if key not in table:
+                table.create_dataset(key, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+        return table
+
+    def _row_index(self):
+        if self._index is None:
+            table = self._table()
+            keys = zip(table["subject"].asstr()[()], table["seed"].asstr()[()])
+            self._index = {key: row for row, key in enumerate(keys)}
+        return self._index
+
+    def write_summary(self, subject, seed, values):
+        """Writes scalar summary values for (subject, seed); new columns are added as needed."""
+        table = self._table()
+        index = self._row_index()
+        n_rows = table["subject"].shape[0]
+
+        row = index.get((subject, seed))
+        if row is None:
+            row = n_rows
+            n_rows += 1
+            for name in table:
+                table[name].resize((n_rows,))
+            table["subject"][row] = subject
+            table["seed"][row] = seed
+            index[(subject, seed)] = row
+
+        for name, value in values.items():
+            if name not in table:
+                table.create_dataset(name, data=np.full(n_rows, np.nan), maxshape=(None,))
+            table[name][row] = value
+
+    def summaries(self):
+        """Returns the summary table as a long DataFrame (subject, seed, summary columns)."""
+        table = self._table()
+        data = {"subject": table["subject"].asstr()[()], "seed": table["seed"].asstr()[()]}
+        for name in table:
+            if name not in data:
+                data[name] = table[name][()]
+        return pd.DataFrame(data)
+
+    # Cohort edge matrices
+
+    def write_edges(self, name, subjects, edges, values, **attrs):
+        """Stores (or replaces) a subjects x edges matrix, e.g. the upper triangles of ROI-to-ROI FC."""
+        group = self.file.require_group("edges")
+        if name in group:
+            del group[name]
+        group = group.create_group(name)
+        group.create_dataset("subject", data=list(subjects), dtype=h5py.string_dtype())
+        group.create_dataset("edge", data=list(edges), dtype=h5py.string_dtype())
+        group.create_dataset("values", data=np.asarray(values, dtype=np.float32), compression="gzip",
+                             compression_opts=4, shuffle=True)
+        for key, value in attrs.items():
+            group.attrs[key] = value
+
+    def read_edges(self, name):
+        """Returns a stored edge matrix as a wide DataFrame (index subject, one column per edge)."""
+        group = self.file[f"edges/{name}"]
+        return pd.DataFrame(group["values"][()], index=pd.Index(group["subject"].asstr()[()], name="subject"),
+                            columns=group["edge"].asstr()[()])
+
+    def edge_sets(self):
+        return sorted(self.file["edges"].keys()) if "edges" in self.file else []
+
+
+def import_npy_dir(store, fc_dir):
+    """Copies legacy {subject}_{seed}_fc.npy files into the store; subject IDs may contain underscores."""
+    n_imported = 0
+    # Longest seed names first, so the suffix match takes the whole seed name
+    seed_names = sorted(seeds, key=len, reverse=True)
+    for fname in sorted(os.listdir(fc_dir)):
+        if not fname.endswith("_fc.npy"):
+            continue
+        stem = fname[:-len("_fc.npy")]
+        seed = next((name for name in seed_names if stem.endswith(f"_{name}") and len(stem) > len(name) + 1), None)
+        if seed is None:
+            print(f"⚠️ {fname}: not {{subject}}_{{seed}}_fc.npy with a known seed, skipped")
+            continue
+        subject = stem[:-len(seed) - 1]
+        store.write_map(subject, seed, np.load(os.path.join(fc_dir, fname)))
+        n_imported += 1
+    return n_imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import legacy per-seed .npy FC maps into the feature store")
+    parser.add_argument("--import-npy", required=True, help="directory with {subject}_{seed}_fc.npy files")
+    parser.add_argument("--store", default=default_store)
+    args = parser.parse_args()
+
+    with FeatureStore(args.store) as store:
+        n_imported = import_npy_dir(store, args.import_npy)
+    print(f"✅ Imported {n_imported} FC maps into {args.store}")
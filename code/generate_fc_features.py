@@ -3,30 +3,18 @@ Loops through subjects and generates FC feature CSVs using seed-based correlatio
 Author: Emre Pelzer
 """
 
-import os
-import numpy as np
-import pandas as pd
+from feature_store import FeatureStore
 
-feature_dir = "features_fc"
+fc_store = "features_fc.h5"
 output_file = "fc_features.csv"
 
-data = []
-
-for file in os.listdir(feature_dir):
-    if file.endswith("_fc.npy"):
-        parts = file.split("_")
-        subject = parts[0]
-        region = "_".join(parts[1:-1])  # for underscore, such as: Hippocampus_left
-
-        filepath = os.path.join(feature_dir, file)
-        value = np.load(filepath)
-        scalar_value = float(value) if value.size == 1 else float(np.mean(value))  # use mean if it is an array
-
-        data.append({"subject": subject, "region": region, "fc": scalar_value})
+# Mean FC per map is precomputed in the store, so no voxel data is loaded here
+with FeatureStore(fc_store, mode="r") as store:
+    df = store.summaries()
 
 # Create dataframe + pivot
-df = pd.DataFrame(data)
+df = df.rename(columns={"seed": "region", "mean_fc": "fc"})
 df_pivot = df.pivot(index="subject", columns="region", values="fc").reset_index()
 
 df_pivot.to_csv(output_file, index=False)
-print(f"✅ Saved {output_file} with shape {df_pivot.shape}")
\ No newline at end of file
+print(f"✅ Saved {output_file} with shape {df_pivot.shape}")
@@ -0,0 +1,100 @@
+"""
+Computes voxelwise SD-BOLD maps (temporal SD per voxel) from the motion-corrected rs-fMRI runs.
+Author: Emre Pelzer
+"""
+
+import argparse
+import os
+import nibabel as nib
+import numpy as np
+from nilearn.image import resample_to_img
+from nilearn.masking import compute_epi_mask
+
+from manifest import layouts, scan
+from nifti_reader import add_cache_arguments, apply_cache_arguments, iter_volumes, open_image, uncompressed_path
+from prefetch import add_prefetch_arguments
+from profiling import add_profile_argument, enable, stage
+from subject_pool import add_pool_arguments, run_subjects
+from welford import TemporalMoments
+
+preproc_dir = "preprocessed"
+output_dir = "features_sdbold"
+
+
+def compute_sdbold(subject_id, img_path, output_path, mask_path=None, auto_mask=False, detrend=False,
+                   cache_dir=None, max_chunk_mb=256):
+    """Streams one run through a one-pass variance accumulator and writes its float32 SD-BOLD map."""
+    img = open_image(img_path, cache_dir)
+    spatial_shape = img.shape[:3]
+
+    # A given mask restricts the accumulator to brain voxels from the start
+    voxels = None
+    if mask_path:
+        with stage("resample"):
+            mask_img = resample_to_img(nib.load(mask_path), nib.Nifti1Image(np.zeros(spatial_shape, np.uint8), img.affine),
+                                       interpolation="nearest", force_resample=True)
+        voxels = np.flatnonzero(np.asanyarray(mask_img.dataobj).ravel(order="F") > 0)
+
+    moments = TemporalMoments(len(voxels) if voxels is not None else int(np.prod(spatial_shape)))
+    # NIfTI volumes are stored voxel-major (Fortran order), so the blocks are flattened in that order: a view,
+    # not a copy, and the accumulator reads one contiguous volume at a time
+    for t0, t1, block in iter_volumes(img, max_chunk_mb=max_chunk_mb):
+        with stage("moments"):
+            moments.update(block.reshape(-1, t1 - t0, order="F"), t0, voxels)
+        del block
+
+    sd_values = moments.std(detrend=detrend).astype(np.float32)
+    sdbold = np.zeros(int(np.prod(spatial_shape)), dtype=np.float32)
+    if voxels is not None:
+        sdbold[voxels] = sd_values
+    else:
+        sdbold[:] = sd_values
+        if auto_mask:
+            mean_img = nib.Nifti1Image(moments.mean.reshape(spatial_shape, order="F").astype(np.float32), img.affine)
+            brain = np.asanyarray(compute_epi_mask(mean_img).dataobj).astype(bool).ravel(order="F")
+            sdbold[~brain] = 0
+
+    with stage("save"):
+        nib.Nifti1Image(sdbold.reshape(spatial_shape, order="F"), img.affine).to_filename(output_path)
+    return output_path
+
+
+def decompress_run(subject_id, img_path, output_path, mask_path=None, auto_mask=False, detrend=False,
+                   cache_dir=None, max_chunk_mb=256):
+    """I/O step run ahead of compute_sdbold: gunzips the run into the cache, where open_image then finds it."""
+    uncompressed_path(img_path, cache_dir)
+    return subject_id, img_path, output_path, mask_path, auto_mask, detrend, cache_dir, max_chunk_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Voxelwise SD-BOLD maps")
+    parser.add_argument("--preproc-dir", default=preproc_dir)
+    parser.add_argument("--output-dir", default=output_dir)
+    masking = parser.add_mutually_exclusive_group()
+    masking.add_argument("--mask", default=None, help="brain mask NIfTI (resampled to each run)")
+    masking.add_argument("--auto-mask", action="store_true", help="mask each run with compute_epi_mask on its mean image")
+    parser.add_argument("--detrend", action="store_true", help="remove a linear trend per voxel before the SD")
+    add_cache_arguments(parser)
+    parser.add_argument("--chunk-mb", type=int, default=256, help="size of the blocks of volumes read at a time")
+    parser.add_argument("--subjects", default=None, help="comma-separated subject IDs to (re)process (default: all)")
+    add_pool_arguments(parser)
+    add_prefetch_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+    apply_cache_arguments(args)
+    only_subjects = set(args.subjects.split(",")) if args.subjects else None
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    tasks = []
+    for subject_id, img_path in scan(args.preproc_dir, layouts["run"][1]).items():
+        if only_subjects is not None and subject_id not in only_subjects:
+            continue
+        output_path = os.path.join(args.output_dir, f"{subject_id}_sdbold.nii.gz")
+        tasks.append((subject_id, (subject_id, img_path, output_path, args.mask, args.auto_mask, args.detrend,
+                                   args.cache_dir, args.chunk_mb)))
+
+    run_subjects(compute_sdbold, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb,
+                 load=decompress_run, prefetch=args.prefetch, prefetch_memory_mb=args.prefetch_memory_mb)
+    print(f"✅ SD-BOLD maps saved to: {args.output_dir}")
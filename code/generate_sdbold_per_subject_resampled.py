@@ -3,50 +3,74 @@ Computes voxelwise SD-BOLD maps per subject and saves extracted features.
 Author: Emre Pelzer
 """
 
-import os
+import argparse
 import nibabel as nib
 import pandas as pd
 import numpy as np
-from nilearn.image import resample_to_img
+
+from manifest import layouts, scan
+from mask_cache import MaskCache, gather
+from prefetch import add_prefetch_arguments
+from profiling import add_profile_argument, enable, stage
+from seed_registry import radius, seeds
+from subject_pool import add_pool_arguments, run_subjects
 
 input_dir = "features_sdbold"
 mask_dir = "seed_masks"
 output_csv = "sdbold_per_subject.csv"
 
-records = []
-
-# Load seed masks
-seed_masks = {}
-for mask_file in os.listdir(mask_dir):
-    if mask_file.endswith("_mask.nii.gz"):
-        seed_name = mask_file.replace("_mask.nii.gz", "")
-        mask_path = os.path.join(mask_dir, mask_file)
-        seed_masks[seed_name] = nib.load(mask_path)
-
-# Process each subject's SD-BOLD map
-for fname in os.listdir(input_dir):
-    if fname.endswith(".nii") or fname.endswith(".nii.gz"):
-        subject_id = fname.split("_")[0]
-        sdbold_path = os.path.join(input_dir, fname)
-        sdbold_img = nib.load(sdbold_path)
-        sdbold_data = sdbold_img.get_fdata()
-        record = {"subject": subject_id}
-
-        for seed, seed_mask_img in seed_masks.items():
-            try:
-                resampled_mask = resample_to_img(seed_mask_img, sdbold_img, interpolation="nearest", force_resample=True)
-                mask_data = resampled_mask.get_fdata().astype(bool)
-
-                if mask_data.shape == sdbold_data.shape:
-                    masked_vals = sdbold_data[mask_data]
-                    record[seed] = np.mean(masked_vals)
-                else:
-                    print(f"⚠️ Shape mismatch for {seed} in {fname}, skipping.")
-            except Exception as e:
-                print(f"⚠️ Failed to process {seed} in {fname}: {e}")
-
-        records.append(record)
-
-df = pd.DataFrame(records)
-df.to_csv(output_csv, index=False)
-print(f"✅ Saved {output_csv} with {len(df)} subjects and {len(seed_masks)} seeds.")
+
+def read_map(subject_id, sdbold_path, seed_indices):
+    """I/O step (run ahead in a background thread when prefetching): reads one SD-BOLD map into memory."""
+    with stage("load", subject_id):
+        img = nib.load(sdbold_path)
+    with stage("read", subject_id):
+        return subject_id, img.get_fdata(), seed_indices
+
+
+def process_subject(subject_id, sdbold_data, seed_indices):
+    """Returns the mean SD-BOLD inside every seed mask for one subject's SD-BOLD map."""
+    record = {"subject": subject_id}
+
+    # Masks arrive as flat voxel indices on this subject's grid, so each ROI is a single gather
+    for seed, indices in seed_indices.items():
+        if indices.size == 0:
+            print(f"⚠️ Empty mask for {seed} in {subject_id}, skipping.")
+            continue
+        record[seed] = np.mean(gather(sdbold_data, indices))
+
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-seed SD-BOLD features")
+    parser.add_argument("--mask-cache-dir", default=None, help="also keep resampled mask indices on disk here")
+    add_pool_arguments(parser)
+    add_prefetch_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+
+    # Each seed mask is resampled once per distinct grid, not once per subject
+    try:
+        mask_cache = MaskCache.from_dir(mask_dir, cache_dir=args.mask_cache_dir, seeds=seeds, radius=radius)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+
+    # Process each subject's SD-BOLD map
+    tasks = []
+    for subject_id, sdbold_path in scan(input_dir, layouts["sdbold"][1]).items():
+        try:
+            seed_indices = mask_cache.indices(nib.load(sdbold_path))
+        except Exception as e:
+            print(f"⚠️ Failed to resample masks for {subject_id}: {e}")
+            continue
+        tasks.append((subject_id, (subject_id, sdbold_path, seed_indices)))
+
+    results, _ = run_subjects(process_subject, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb,
+                              load=read_map, prefetch=args.prefetch, prefetch_memory_mb=args.prefetch_memory_mb)
+    records = list(results.values())
+
+    df = pd.DataFrame(records)
+    df.to_csv(output_csv, index=False)
+    print(f"✅ Saved {output_csv} with {len(df)} subjects and {len(mask_cache.mask_imgs)} seeds.")
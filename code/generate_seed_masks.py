@@ -1,51 +1,75 @@
 """
 Generates spherical ROI seed masks for FC analysis based on MNI coordinates.
 Author: Emre Pelzer
+
+All seeds are computed in one pass from a bounding box around each sphere, with the radius in mm taken
+through the real voxel sizes of the grid. Next to every {seed}_mask.nii.gz the flat voxel indices are saved as
+{seed}_mask_idx.npy, with the grid they belong to in grid.json, so extraction can use them without resampling.
 """
 
+import argparse
+import json
 import os
+import nibabel as nib
 import numpy as np
 from nilearn import datasets
-from nilearn.image import new_img_like, coord_transform
-from nibabel import Nifti1Image
-
-# Seed coordinates
-seeds = {
-    "mPFC": [1, 55, -3],
-    "PCC": [1, -61, 38],
-    "LP_left": [-39, -77, 33],
-    "LP_right": [47, -67, 29],
-    "ACC": [0, 22, 35],
-    "AINS_left": [-44, 13, 1],
-    "AINS_right": [47, 14, 0],
-    "RPFC_left": [-32, 45, 27],
-    "RPFC_right": [32, 46, 27],
-    "SMG_left": [-60, -39, 31],
-    "SMG_right": [62, -35, 32],
-    "Hippocampus_left": [-28, -6, -12],
-    "Hippocampus_right": [30, -8, -14],
-}
-
-radius = 6  # in mm
-mni_img = datasets.load_mni152_template()
+
+from manifest import layouts, scan
+from mask_cache import grid_key
+from roi_extract import sphere_indices
+from seed_registry import radius, seeds
+
 output_dir = "seed_masks"
-os.makedirs(output_dir, exist_ok=True)
-
-for name, coord in seeds.items():
-    # Create a binary 3D mask with a sphere at the given coordinate
-    affine = mni_img.affine
-    shape = mni_img.shape
-    mask_data = np.zeros(shape, dtype=np.uint8)
-
-    # Convert MNI coordinate to voxel index
-    i, j, k = np.round(coord_transform(coord[0], coord[1], coord[2], np.linalg.inv(affine))).astype(int)
-
-    # Fill in a small sphere (radius in voxels is roughly (radius / 2) as voxel size is ~2mm)
-    rr, cc, zz = np.ogrid[:shape[0], :shape[1], :shape[2]]
-    mask = (rr - i)**2 + (cc - j)**2 + (zz - k)**2 <= (radius // 2)**2
-    mask_data[mask] = 1
-
-    mask_img = new_img_like(mni_img, mask_data)
-    path = os.path.join(output_dir, f"{name}_mask.nii.gz")
-    mask_img.to_filename(path)
-    print(f"✅ Saved: {path}")
\ No newline at end of file
+
+
+def write_masks(out_dir, affine, shape, coords=seeds, radius=radius, write_nifti=True):
+    """Writes the sphere masks of all seeds on one grid; returns {seed: flat voxel indices}."""
+    os.makedirs(out_dir, exist_ok=True)
+    shape = tuple(int(s) for s in shape[:3])
+    index_dtype = np.int32 if np.prod(shape) < 2 ** 31 else np.int64
+    indices = sphere_indices(coords, radius, affine, shape)
+
+    # Files of seeds that were removed from the registry would otherwise linger next to the new ones
+    for fname in os.listdir(out_dir):
+        for suffix in ("_mask_idx.npy", "_mask.nii.gz"):
+            if fname.endswith(suffix) and fname[:-len(suffix)] not in indices:
+                os.remove(os.path.join(out_dir, fname))
+
+    for name, idx in indices.items():
+        if len(idx) == 0:
+            print(f"⚠️ Seed {name} lies outside the grid of {out_dir}")
+        np.save(os.path.join(out_dir, f"{name}_mask_idx.npy"), idx.astype(index_dtype))
+        if write_nifti:
+            mask_data = np.zeros(int(np.prod(shape)), dtype=np.uint8)
+            mask_data[idx] = 1
+            nib.Nifti1Image(mask_data.reshape(shape), affine).to_filename(os.path.join(out_dir, f"{name}_mask.nii.gz"))
+
+    grid = {"grid_key": grid_key(nib.Nifti1Image(np.zeros(shape, np.uint8), affine)),
+            "affine": np.asarray(affine).tolist(), "shape": list(shape), "radius_mm": radius, "seeds": coords}
+    with open(os.path.join(out_dir, "grid.json"), "w") as f:
+        json.dump(grid, f, indent=1)
+    return indices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spherical seed masks")
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--target-dir", default=None,
+                        help="also write masks on the native grid of every *_mc.nii.gz run in this folder (into <output-dir>/native/<subject>)")
+    parser.add_argument("--no-nifti", action="store_true", help="only write the index files for native grids")
+    args = parser.parse_args()
+
+    # MNI template masks, as before
+    mni_img = datasets.load_mni152_template()
+    for name, idx in write_masks(args.output_dir, mni_img.affine, mni_img.shape).items():
+        print(f"✅ Saved: {os.path.join(args.output_dir, f'{name}_mask.nii.gz')} ({len(idx)} voxels)")
+
+    if args.target_dir:
+        # Only headers are read; subjects sharing a grid still get their own folder
+        n_subjects = 0
+        for subject, path in scan(args.target_dir, layouts["run"][1]).items():
+            img = nib.load(path)
+            write_masks(os.path.join(args.output_dir, "native", subject), img.affine, img.shape,
+                        write_nifti=not args.no_nifti)
+            n_subjects += 1
+        print(f"✅ Native-space masks saved for {n_subjects} subjects in: {os.path.join(args.output_dir, 'native')}")
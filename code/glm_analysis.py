@@ -0,0 +1,165 @@
+"""
+Covariate-adjusted GLM: feature ~ score + BDI (+ other covariates) for every seed and score at once, and with
+--voxelwise for every voxel of the FC or SD-BOLD maps.
+Author: Emre Pelzer
+
+Each score has one design matrix shared by all seeds (or voxels), and features missing the same subjects are
+solved together with one pseudo-inverse. The tables keep the p column apply_fdr_correction.py reads.
+"""
+
+import argparse
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from feature_store import FeatureStore
+from manifest import Manifest, load_scores
+from mass_stats import glm, glm_design, glm_table
+from prefetch import add_prefetch_arguments, prefetch
+from profiling import add_profile_argument, enable, stage
+
+fc_store = "features_fc.h5"
+sdbold_file = "sdbold_per_subject.csv"
+sdbold_dir = "features_sdbold"
+cog_file = "cognitive_scores_normalized.csv"
+output_dir = "glm_maps"
+covariates = "BDI"
+
+
+def load_design_table(score_file, covariate_file=None, scores=None, covariates=()):
+    """Scores and covariates per subject; covariates can also come from a second CSV (subject + columns)."""
+    table = load_scores(score_file)
+    if covariate_file:
+        extra = load_scores(covariate_file)
+        table = table.join(extra[[c for c in extra.columns if c not in table.columns]], how="left")
+    missing = [c for c in covariates if c not in table.columns]
+    if missing:
+        raise SystemExit(f"❌ Covariates not found: {', '.join(missing)}")
+    if scores:
+        table = table[list(dict.fromkeys(scores + list(covariates)))]
+    return table
+
+
+def fc_features(store_path):
+    """Subjects x seeds matrix of mean FC from the feature store."""
+    with stage("load"), FeatureStore(store_path, mode="r") as store:
+        summaries = store.summaries()[["subject", "seed", "mean_fc"]]
+    return summaries.pivot(index="subject", columns="seed", values="mean_fc")
+
+
+def seed_glm(features, table, covariates, output_csv):
+    """GLM table for one subjects x features matrix, aligned with the scores by subject."""
+    merged = features.join(table, how="inner")
+    with stage("statistics"):
+        results = glm_table(merged[features.columns], merged[table.columns], covariates)
+    results.to_csv(output_csv, index=False)
+    print(f"✅ GLM ({len(merged)} subjects, covariates: {', '.join(covariates) or 'none'}) saved to: {output_csv}")
+
+
+def voxelwise_glm(name, map_loader, subjects, table, covariates, out_dir, chunk_mb=256, prefetch_depth=0,
+                  prefetch_memory_mb=1024):
+    """
+    Voxelwise t/p maps of every score for one map type. map_loader(subject) returns (map, affine) or None.
+    The maps are stacked once (subjects x voxels, float32, 0 = missing) and fitted in voxel blocks.
+    """
+    def read(subject):
+        with stage("read", subject):
+            return map_loader(subject)
+
+    maps, kept = [], []
+    shape = affine = None
+    for subject, loaded, error in prefetch(subjects, read, prefetch_depth, prefetch_memory_mb):
+        if error is not None:
+            raise error
+        if loaded is None:
+            continue
+        data, subject_affine = loaded
+        if shape is None:
+            shape, affine = data.shape, subject_affine
+        elif data.shape != shape:
+            print(f"⚠️ Skipped {subject} for {name}: grid {data.shape} differs from {shape}")
+            continue
+        maps.append(np.asarray(data, dtype=np.float32).ravel())
+        kept.append(subject)
+    if not maps:
+        print(f"⚠️ No maps found for {name}")
+        return
+
+    Y = np.vstack(maps)
+    Y[Y == 0] = np.nan  # voxels without signal
+    scores = table.loc[kept]
+    block = int(max(1, chunk_mb * 1024 ** 2 // (8 * 3 * len(kept))))
+
+    for score in [s for s in table.columns if s not in covariates]:
+        rows, X = glm_design(scores, score, covariates)
+        t = np.full(Y.shape[1], np.nan, dtype=np.float32)
+        p = np.full(Y.shape[1], np.nan, dtype=np.float32)
+        with stage("statistics"):
+            for v0 in range(0, Y.shape[1], block):
+                _, _, t_block, p_block, _ = glm(Y[rows, v0:v0 + block], X)
+                t[v0:v0 + block] = t_block
+                p[v0:v0 + block] = p_block
+        with stage("save"):
+            for stat, values in (("t", t), ("p", p)):
+                nib.Nifti1Image(values.reshape(shape), affine).to_filename(
+                    os.path.join(out_dir, f"{name}_{score}_glm_{stat}.nii.gz"))
+    print(f"✅ Saved voxelwise GLM maps for {name} (n = {len(kept)} subjects)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Covariate-adjusted GLM of features on cognitive scores")
+    parser.add_argument("--feature", choices=["fc", "sdbold", "both"], default="both")
+    parser.add_argument("--features", default=None, help="wide CSV (subject + one column per feature, e.g. fc_edges.csv) instead")
+    parser.add_argument("--scores", default=None, help="comma-separated score columns (default: all but the covariates)")
+    parser.add_argument("--covariates", default=covariates, help="comma-separated nuisance columns ('' = none)")
+    parser.add_argument("--covariate-file", default=None, help="extra CSV with subject + covariate columns (e.g. age, mean FD)")
+    parser.add_argument("--voxelwise", action="store_true", help="fit every voxel of the maps instead of the seed means")
+    parser.add_argument("--seeds", default=None, help="comma-separated seeds for --voxelwise FC (default: all)")
+    parser.add_argument("--store", default=fc_store)
+    parser.add_argument("--sdbold-dir", default=sdbold_dir)
+    parser.add_argument("--output-dir", default=output_dir, help="where the --voxelwise maps are written")
+    parser.add_argument("--chunk-mb", type=int, default=256, help="size of the voxel blocks fitted at a time")
+    add_prefetch_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+
+    nuisance = [c for c in args.covariates.split(",") if c]
+    table = load_design_table(cog_file, args.covariate_file, args.scores.split(",") if args.scores else None, nuisance)
+    kinds = ["fc", "sdbold"] if args.feature == "both" else [args.feature]
+
+    if args.features:
+        stem = os.path.splitext(os.path.basename(args.features))[0]
+        features = pd.read_csv(args.features, dtype={"subject": str}).set_index("subject")
+        seed_glm(features, table, nuisance, f"{stem}_glm_results.csv")
+    elif not args.voxelwise:
+        if "fc" in kinds:
+            seed_glm(fc_features(args.store), table, nuisance, "fc_glm_results.csv")
+        if "sdbold" in kinds:
+            features = pd.read_csv(sdbold_file, dtype={"subject": str}).set_index("subject")
+            seed_glm(features, table, nuisance, "sdbold_glm_results.csv")
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        if "fc" in kinds:
+            with FeatureStore(args.store, mode="r") as store:
+                subjects = [s for s in store.subjects() if s in table.index]
+                seeds = args.seeds.split(",") if args.seeds else sorted({seed for s in subjects for seed in store.seeds(s)})
+                for seed in seeds:
+                    def load_fc(subject):
+                        if not store.has_map(subject, seed):
+                            return None
+                        return store.read_map(subject, seed), store.read_affine(subject, seed)
+
+                    voxelwise_glm(f"{seed}_fc", load_fc, subjects, table, nuisance, args.output_dir, args.chunk_mb,
+                                  args.prefetch, args.prefetch_memory_mb)
+        if "sdbold" in kinds:
+            manifest = Manifest(kinds=["sdbold"], dirs={"sdbold": args.sdbold_dir})
+
+            def load_sdbold(subject):
+                img = nib.load(manifest.path("sdbold", subject))
+                return img.get_fdata(dtype=np.float32), img.affine
+
+            subjects = [s for s in manifest.subjects("sdbold") if s in table.index]
+            voxelwise_glm("sdbold", load_sdbold, subjects, table, nuisance, args.output_dir, args.chunk_mb,
+                          args.prefetch, args.prefetch_memory_mb)
@@ -0,0 +1,114 @@
+"""
+Subject manifest: every subject's files (preprocessed run, SD-BOLD map, ...) and cognitive scores in one
+dict-indexed table, so scripts look subjects up instead of scanning folders and DataFrames.
+Author: Emre Pelzer
+
+Folder listings are cached in .manifest_cache.json together with the folder's mtime; a folder is only listed
+again after files were added, removed or renamed in it, which keeps large cohorts on network drives fast.
+"""
+
+import json
+import os
+import re
+import time
+import pandas as pd
+
+cache_file = ".manifest_cache.json"
+
+# File kinds: folder and the suffix that follows the subject ID
+layouts = {
+    "run": ("preprocessed", "_mc.nii.gz"),
+    "sdbold": ("features_sdbold", "_sdbold.nii.gz"),
+}
+
+# Trailing BIDS key-value entities (_task-rest, _ses-1, ...) between the subject ID and the suffix
+_entities = re.compile(r"(_[a-zA-Z]+-[a-zA-Z0-9]+)+$")
+
+
+def subject_id(fname, suffix):
+    """
+    Subject ID of a file name, or None if it does not end with suffix. The suffix and any BIDS entities before
+    it are removed, so IDs may contain underscores: P_001_sdbold.nii.gz -> P_001,
+    sub-01_task-rest_mc.nii.gz -> sub-01.
+    """
+    if not fname.endswith(suffix) or fname.startswith("."):
+        return None
+    stem = _entities.sub("", fname[:-len(suffix)])
+    return stem or None
+
+
+def _load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def scan(folder, suffix, cache_path=cache_file):
+    """{subject: path} of the files in folder ending with suffix, sorted by subject; cached by folder mtime."""
+    if not os.path.isdir(folder):
+        return {}
+    key = f"{os.path.abspath(folder)}|{suffix}"
+    mtime = os.stat(folder).st_mtime_ns
+    cache = _load_cache(cache_path) if cache_path else {}
+    entry = cache.get(key)
+
+    if entry is None or entry["mtime_ns"] != mtime:
+        files = {}
+        for fname in sorted(os.listdir(folder)):
+            subject = subject_id(fname, suffix)
+            if subject is None:
+                continue
+            if subject in files:
+                print(f"⚠️ {subject}: several files in {folder}, using {files[subject]}")
+                continue
+            files[subject] = fname
+        entry = {"mtime_ns": mtime, "files": files}
+        # A folder changed within the last seconds may change again within the same mtime tick (coarse on NFS)
+        if cache_path and time.time_ns() - mtime > 2 * 10 ** 9:
+            cache[key] = entry
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+
+    return {subject: os.path.join(folder, fname) for subject, fname in sorted(entry["files"].items())}
+
+
+def load_scores(path):
+    """Score table indexed by subject; IDs are read as strings so leading zeros survive."""
+    scores = pd.read_csv(path, dtype={"subject": str}).set_index("subject")
+    duplicated = scores.index.duplicated()
+    if duplicated.any():
+        print(f"⚠️ Duplicate subjects in {path}, keeping the first row: {', '.join(scores.index[duplicated])}")
+        scores = scores[~duplicated]
+    return scores
+
+
+class Manifest:
+    """
+    files[kind][subject] -> path for every kind in layouts (folders can be overridden with dirs={kind: folder}),
+    scores: the score table indexed by subject (or None without a score file).
+    """
+
+    def __init__(self, score_file=None, kinds=None, dirs=None, cache_path=cache_file):
+        dirs = dirs or {}
+        self.files = {}
+        for kind in layouts if kinds is None else kinds:
+            folder, suffix = layouts[kind]
+            self.files[kind] = scan(dirs.get(kind, folder), suffix, cache_path)
+        self.scores = load_scores(score_file) if score_file else None
+
+    def subjects(self, *kinds):
+        """Sorted subjects that have a file of every given kind (and scores, when a score file was loaded)."""
+        sets = [set(self.files[kind]) for kind in kinds]
+        if self.scores is not None:
+            sets.append(set(self.scores.index))
+        return sorted(set.intersection(*sets)) if sets else []
+
+    def path(self, kind, subject):
+        """Path of a subject's file of one kind, or None if it has none."""
+        return self.files[kind].get(subject)
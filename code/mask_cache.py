@@ -0,0 +1,136 @@
+"""
+Caches seed masks resampled to a target grid as flat voxel-index arrays, keyed by (affine, shape).
+Author: Emre Pelzer
+"""
+
+import glob
+import hashlib
+import json
+import os
+import nibabel as nib
+import numpy as np
+from nilearn.image import resample_to_img
+
+from profiling import stage
+
+
+def grid_key(img):
+    """Hash of an image grid (affine + 3D shape). Tiny float noise in the affine is rounded away."""
+    affine = np.round(np.asarray(img.affine, dtype=np.float64), 5) + 0.0  # + 0.0 turns -0.0 into 0.0
+    shape = np.asarray(img.shape[:3], dtype=np.int64)
+    return hashlib.sha1(affine.tobytes() + shape.tobytes()).hexdigest()[:16]
+
+
+def gather(data, indices):
+    """Values of a 3D (or 4D) array at flat C-order voxel indices -> (n_voxels,) or (n_voxels, t)."""
+    return data[np.unravel_index(indices, data.shape[:3])]
+
+
+def _stale(index_dir, seeds=None, radius=None):
+    """True if index_dir/grid.json records seeds or a radius other than the given ones."""
+    grid_file = os.path.join(index_dir, "grid.json")
+    if not os.path.exists(grid_file):
+        return False
+    with open(grid_file) as f:
+        grid = json.load(f)
+    # Through JSON, so tuples and lists of coordinates compare equal
+    return ((seeds is not None and grid.get("seeds") != json.loads(json.dumps(seeds)))
+            or (radius is not None and grid.get("radius_mm") != radius))
+
+
+class MaskCache:
+    """
+    Resamples every seed mask at most once per target grid.
+    Results are kept in memory and, if cache_dir is given, as one .npz per grid on disk.
+    """
+
+    def __init__(self, mask_imgs, cache_dir=None):
+        self.mask_imgs = mask_imgs
+        self.cache_dir = cache_dir
+        self._grids = {}
+
+        # Masks are part of the disk key, so editing a mask invalidates old entries
+        digest = hashlib.sha1()
+        for seed in sorted(mask_imgs):
+            img = mask_imgs[seed]
+            digest.update(seed.encode())
+            digest.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+            digest.update(np.ascontiguousarray(np.asanyarray(img.dataobj) > 0).tobytes())
+        self._masks_key = digest.hexdigest()[:16]
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_dir(cls, mask_dir, cache_dir=None, seeds=None, radius=None):
+        """
+        Loads every *_mask.nii.gz in mask_dir, plus the index files written by generate_seed_masks.py
+        for the template grid and for native grids (mask_dir/native/<subject>), which need no resampling.
+        With seeds / radius (the seed registry), masks written for other seeds or another radius are refused:
+        stale template masks raise a ValueError, stale native index files are skipped and resampled instead.
+        """
+        mask_imgs = {}
+        for mask_file in sorted(os.listdir(mask_dir)):
+            if mask_file.endswith("_mask.nii.gz"):
+                seed_name = mask_file.replace("_mask.nii.gz", "")
+                mask_imgs[seed_name] = nib.load(os.path.join(mask_dir, mask_file))
+        cache = cls(mask_imgs, cache_dir)
+        if _stale(mask_dir, seeds, radius):
+            raise ValueError(f"Masks in {mask_dir} were made for other seeds or another radius; "
+                             f"rerun generate_seed_masks.py")
+        for index_dir in [mask_dir] + sorted(glob.glob(os.path.join(mask_dir, "native", "*"))):
+            cache.add_index_dir(index_dir, seeds, radius)
+        return cache
+
+    def add_index_dir(self, index_dir, seeds=None, radius=None):
+        """
+        Registers the {seed}_mask_idx.npy files of one grid (described by grid.json) if all seeds are there
+        and, when given, grid.json records the same seeds and radius.
+        """
+        grid_file = os.path.join(index_dir, "grid.json")
+        if not os.path.exists(grid_file):
+            return False
+        if _stale(index_dir, seeds, radius):
+            print(f"⚠️ Ignoring {index_dir}: made for other seeds or another radius (rerun generate_seed_masks.py)")
+            return False
+        with open(grid_file) as f:
+            key = json.load(f)["grid_key"]
+        paths = {seed: os.path.join(index_dir, f"{seed}_mask_idx.npy") for seed in self.mask_imgs}
+        if key in self._grids or not paths or not all(map(os.path.exists, paths.values())):
+            return False
+        self._grids[key] = {seed: np.load(path) for seed, path in paths.items()}
+        return True
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"masks_{self._masks_key}_{key}.npz")
+
+    def indices(self, target_img):
+        """Returns {seed: flat voxel indices} of every mask on the grid of target_img."""
+        key = grid_key(target_img)
+        if key in self._grids:
+            return self._grids[key]
+
+        if self.cache_dir and os.path.exists(self._disk_path(key)):
+            with np.load(self._disk_path(key)) as cached:
+                self._grids[key] = {seed: cached[seed] for seed in cached.files}
+            return self._grids[key]
+
+        n_voxels = int(np.prod(target_img.shape[:3]))
+        index_dtype = np.int32 if n_voxels < 2 ** 31 else np.int64
+        grid = {}
+        for seed, mask_img in self.mask_imgs.items():
+            if grid_key(mask_img) == key:
+                # Mask already on this grid: no resampling needed
+                grid[seed] = np.flatnonzero(np.asanyarray(mask_img.dataobj) > 0).astype(index_dtype)
+                continue
+            with stage("resample"):
+                resampled = resample_to_img(mask_img, target_img, interpolation="nearest", force_resample=True)
+            grid[seed] = np.flatnonzero(np.asanyarray(resampled.dataobj) > 0).astype(index_dtype)
+
+        if self.cache_dir:
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, **grid)
+            os.replace(tmp_path, self._disk_path(key))
+
+        self._grids[key] = grid
+        return grid
@@ -0,0 +1,204 @@
+"""
+Batched correlation statistics: every feature x score Pearson r and p-value from matrix products.
+Author: Emre Pelzer
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+
+
+def _masked_moments(X, Y):
+    """Pairwise-complete sums for every column pair of X (..., n, p) and Y (..., n, q)."""
+    mx = np.isfinite(X).astype(np.float64)
+    my = np.isfinite(Y).astype(np.float64)
+    x = np.where(mx > 0, X, 0.0)
+    y = np.where(my > 0, Y, 0.0)
+
+    xt = np.swapaxes(x, -1, -2)
+    mxt = np.swapaxes(mx, -1, -2)
+    n = mxt @ my
+    sx = xt @ my
+    sy = mxt @ y
+    sxx = np.swapaxes(x ** 2, -1, -2) @ my
+    syy = mxt @ y ** 2
+    sxy = xt @ y
+    return n, sx, sy, sxx, syy, sxy
+
+
+def correlate(X, Y):
+    """
+    Pearson r between every column of X (n, p) and every column of Y (n, q) -> r (p, q), n (p, q).
+    NaNs are handled pairwise: each pair uses the subjects where both values are present.
+    Leading batch dimensions are allowed, e.g. X (b, n, p) for resampled data.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+
+    # Center on the column means first so the raw sums below don't lose precision
+    X = X - np.nanmean(X, axis=-2, keepdims=True)
+    Y = Y - np.nanmean(Y, axis=-2, keepdims=True)
+
+    n, sx, sy, sxx, syy, sxy = _masked_moments(X, Y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = n * sxy - sx * sy
+        var_x = n * sxx - sx ** 2
+        var_y = n * syy - sy ** 2
+        r = cov / np.sqrt(var_x * var_y)
+    r[(n < 2) | (var_x <= 0) | (var_y <= 0)] = np.nan
+    return np.clip(r, -1, 1), n
+
+
+def correlation_pvalues(r, n):
+    """Two-sided p-values of Pearson r with n observations (t distribution, n - 2 df), as in pearsonr."""
+    df = np.asarray(n, dtype=np.float64) - 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = r * np.sqrt(df / (1 - r ** 2))
+        p = 2 * t_dist.sf(np.abs(t), df)
+    p = np.where(df > 0, p, np.nan)
+    return p
+
+
+def correlation_table(features, scores, feature_col="seed", score_col="score", r_col="r", p_col="p"):
+    """
+    Correlates every column of the features DataFrame with every column of the scores DataFrame
+    (rows already aligned by subject) and returns a long table with one row per pair.
+    """
+    r, n = correlate(features.to_numpy(dtype=np.float64), scores.to_numpy(dtype=np.float64))
+    p = correlation_pvalues(r, n)
+    return pd.DataFrame({
+        feature_col: np.repeat(features.columns.to_numpy(), scores.shape[1]),
+        score_col: np.tile(scores.columns.to_numpy(), features.shape[1]),
+        r_col: r.ravel(),
+        p_col: p.ravel(),
+        "n": n.ravel().astype(int),
+    })
+
+
+class StreamingCorrelation:
+    """
+    Voxelwise Pearson r between a map value and each score across subjects, accumulated one subject at a
+    time. Only running sums (voxels x scores) are kept, never the subjects x voxels matrix.
+    Non-finite map values and missing scores are skipped pairwise.
+    """
+
+    def __init__(self, n_voxels, n_scores):
+        shape = (n_voxels, n_scores)
+        self.n = np.zeros(shape)
+        self.sx = np.zeros(shape)
+        self.sy = np.zeros(shape)
+        self.sxx = np.zeros(shape)
+        self.syy = np.zeros(shape)
+        self.sxy = np.zeros(shape)
+        self.x_ref = None
+        self.y_ref = None
+
+    def update(self, x, y):
+        """Adds one subject: x is the flattened map (n_voxels,), y the scores (n_scores,)."""
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64)
+
+        # Shift by the first subject's values so the raw sums stay well conditioned
+        if self.x_ref is None:
+            self.x_ref = np.where(np.isfinite(x), x, 0.0)
+            self.y_ref = np.where(np.isfinite(y), y, 0.0)
+
+        vx = np.isfinite(x)
+        vy = np.isfinite(y)
+        x0 = np.where(vx, x - self.x_ref, 0.0)
+        y0 = np.where(vy, y - self.y_ref, 0.0)
+
+        self.n += np.outer(vx, vy)
+        self.sx += np.outer(x0, vy)
+        self.sy += np.outer(vx, y0)
+        self.sxx += np.outer(x0 ** 2, vy)
+        self.syy += np.outer(vx, y0 ** 2)
+        self.sxy += np.outer(x0, y0)
+
+    def result(self):
+        """Returns (r, p, n), each of shape (n_voxels, n_scores)."""
+        n = self.n
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cov = n * self.sxy - self.sx * self.sy
+            var_x = n * self.sxx - self.sx ** 2
+            var_y = n * self.syy - self.sy ** 2
+            r = cov / np.sqrt(var_x * var_y)
+        r[(n < 2) | (var_x <= 0) | (var_y <= 0)] = np.nan
+        r = np.clip(r, -1, 1)
+        return r, correlation_pvalues(r, n), n
+
+
+def _missing_patterns(valid):
+    """Groups the columns of a boolean (n, m) matrix by pattern -> yields (rows present, column indices)."""
+    packed = np.packbits(valid, axis=0)
+    _, first, inverse = np.unique(packed, axis=1, return_index=True, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind="stable")
+    bounds = np.cumsum(np.bincount(inverse.ravel()))[:-1]
+    for group_first, columns in zip(first, np.split(order, bounds)):
+        yield valid[:, group_first], columns
+
+
+def glm(Y, X, test=1):
+    """
+    Ordinary least squares of every column of Y (n, m) on one design X (n, k), all columns at once.
+    Columns are grouped by which subjects have values (NaN = missing); each group is solved with a single
+    pseudo-inverse of its rows of X. Returns beta, se, t, p of design column `test` and n, each of shape (m,).
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    k = X.shape[1]
+    m = Y.shape[1]
+    beta = np.full(m, np.nan)
+    se = np.full(m, np.nan)
+    n = np.zeros(m, dtype=int)
+
+    for rows, columns in _missing_patterns(np.isfinite(Y)):
+        n_rows = int(rows.sum())
+        n[columns] = n_rows
+        Xr = X[rows]
+        if n_rows <= k or np.linalg.matrix_rank(Xr) < k:
+            continue
+        # For a full-rank design, (X'X)^-1 = pinv(X) pinv(X)'
+        pinv = np.linalg.pinv(Xr)
+        Yr = Y[np.ix_(rows, columns)]
+        B = pinv @ Yr
+        rss = ((Yr - Xr @ B) ** 2).sum(axis=0)
+        beta[columns] = B[test]
+        se[columns] = np.sqrt(rss / (n_rows - k) * (pinv[test] @ pinv[test]))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = beta / se
+        df = (n - k).astype(np.float64)
+        p = np.where(df > 0, 2 * t_dist.sf(np.abs(t), np.maximum(df, 1)), np.nan)
+    return beta, se, t, p, n
+
+
+def glm_design(scores, score, covariates):
+    """Design [intercept, score, covariates...] of the subjects that have the score and every covariate."""
+    columns = [score] + [c for c in covariates if c != score]
+    values = scores[columns].to_numpy(dtype=np.float64)
+    rows = np.isfinite(values).all(axis=1)
+    return rows, np.column_stack([np.ones(rows.sum()), values[rows]])
+
+
+def glm_table(features, scores, covariates=(), feature_col="seed", score_col="score"):
+    """
+    Fits feature ~ score + covariates for every column of features and every column of scores (rows already
+    aligned by subject). Each score has one design shared by all features. Returns a long table with one row
+    per pair: beta, se, t and p of the score, and n.
+    """
+    Y = features.to_numpy(dtype=np.float64)
+    tested = [s for s in scores.columns if s not in covariates]
+    stats = np.full((5, features.shape[1], len(tested)), np.nan)
+    for j, score in enumerate(tested):
+        rows, X = glm_design(scores, score, covariates)
+        stats[:, :, j] = glm(Y[rows], X)
+    return pd.DataFrame({
+        feature_col: np.repeat(features.columns.to_numpy(), len(tested)),
+        score_col: np.tile(np.array(tested, dtype=object), features.shape[1]),
+        "beta": stats[0].ravel(),
+        "se": stats[1].ravel(),
+        "t": stats[2].ravel(),
+        "p": stats[3].ravel(),
+        "n": stats[4].ravel().astype(int),
+    })
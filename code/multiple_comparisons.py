@@ -0,0 +1,246 @@
+"""
+Multiple-comparison correction for result tables and voxelwise maps: Benjamini-Hochberg / Benjamini-Yekutieli
+FDR, and cluster-extent inference with a permutation null of the largest cluster.
+Author: Emre Pelzer
+
+FDR sorts the p-values once (O(n log n)). Maps are corrected one at a time; with --pool one threshold is found
+for all maps together from only the p-values below alpha, so memory stays bounded by about one map.
+"""
+
+import argparse
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.special import digamma
+
+from mass_stats import StreamingCorrelation
+from permutation import permutation_indices
+from prefetch import prefetch
+from profiling import add_profile_argument, enable, stage
+
+# Recognized p-value columns, in order of preference
+p_columns = ["p", "p_value", "pval", "p_val"]
+structures = {6: 1, 18: 2, 26: 3}  # voxel connectivity -> ndimage connectivity rank
+
+
+def find_p_column(df):
+    """Name of the p-value column of a result table, or None."""
+    return next((c for c in p_columns if c in df.columns), None)
+
+
+def _by_factor(m):
+    """Benjamini-Yekutieli correction sum(1/i, i = 1..m), without building the m-element array."""
+    return float(digamma(m + 1) + np.euler_gamma)
+
+
+def fdr(p, alpha=0.05, method="bh"):
+    """
+    q-values (adjusted p-values) and rejections of BH ("bh") or BY ("by") FDR for p-values of any shape.
+    NaNs are not counted as tests and stay NaN.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    flat = p.ravel()
+    valid = np.flatnonzero(np.isfinite(flat))
+    q = np.full(flat.shape, np.nan)
+    m = len(valid)
+    if m:
+        order = valid[np.argsort(flat[valid], kind="stable")]
+        scale = m / np.arange(1, m + 1)
+        if method == "by":
+            scale *= _by_factor(m)
+        # q of the k-th smallest p is the smallest p(j) * m / j over j >= k
+        q[order] = np.minimum(np.minimum.accumulate((flat[order] * scale)[::-1])[::-1], 1)
+    q = q.reshape(p.shape)
+    return q, np.nan_to_num(q, nan=np.inf) <= alpha
+
+
+def fdr_threshold(p_arrays, alpha=0.05, method="bh"):
+    """
+    BH/BY over several arrays treated as one family, reading each array once and keeping only its p-values
+    <= alpha (every rejected p is among them). Returns (largest rejected p, or 0 if none, number of tests).
+    """
+    m = 0
+    candidates = []
+    for p in p_arrays:
+        p = np.asarray(p, dtype=np.float64).ravel()
+        p = p[np.isfinite(p)]
+        m += p.size
+        candidates.append(p[p <= alpha])
+    candidates = np.sort(np.concatenate(candidates)) if candidates else np.zeros(0)
+    factor = _by_factor(m) if method == "by" else 1.0
+    passed = np.flatnonzero(candidates <= np.arange(1, len(candidates) + 1) * alpha / (max(m, 1) * factor))
+    return (candidates[passed[-1]] if len(passed) else 0.0), m
+
+
+def correct_table(df, column=None, alpha=0.05, method="bh"):
+    """Adds p_fdr and significant_fdr to a result table; the p column is detected unless given."""
+    column = column or find_p_column(df)
+    if column is None:
+        raise ValueError(f"no p-value column (looked for {', '.join(p_columns)})")
+    q, rejected = fdr(df[column].to_numpy(dtype=np.float64), alpha, method)
+    df = df.copy()
+    df["p_fdr"] = q
+    df["significant_fdr"] = rejected
+    return df, column
+
+
+def label_clusters(mask, connectivity=26):
+    """Connected components of a 3D boolean mask -> (label volume, size of every cluster; label i has sizes[i - 1])."""
+    structure = ndimage.generate_binary_structure(3, structures[connectivity])
+    labels, n_clusters = ndimage.label(mask, structure)
+    return labels, np.bincount(labels.ravel(), minlength=n_clusters + 1)[1:]
+
+
+def cluster_table(labels, sizes, affine, stat=None, null=None, min_size=1):
+    """
+    One row per cluster of at least min_size voxels: size, peak voxel (largest |stat|, or the centre of mass)
+    in voxel and world coordinates, and with null (max cluster sizes under permutation) a corrected p-value.
+    All clusters are measured in one pass over the volume.
+    """
+    keep = np.flatnonzero(sizes >= min_size) + 1
+    if len(keep) == 0:
+        peaks = np.zeros((0, 3), dtype=int)
+    elif stat is not None:
+        peaks = np.array(ndimage.maximum_position(np.abs(np.nan_to_num(stat)), labels, keep), dtype=int)
+    else:
+        peaks = np.rint(ndimage.center_of_mass(labels > 0, labels, keep)).astype(int)
+    peaks = peaks.reshape(-1, 3)
+    world = nib.affines.apply_affine(affine, peaks)
+
+    table = pd.DataFrame({"cluster": keep, "size": sizes[keep - 1], "i": peaks[:, 0], "j": peaks[:, 1], "k": peaks[:, 2],
+                          "x": world[:, 0], "y": world[:, 1], "z": world[:, 2]})
+    if stat is not None:
+        table["peak_stat"] = np.asarray(stat, dtype=np.float64)[tuple(peaks.T)]
+    if null is not None:
+        # Null maxima at least as large as each cluster, counted with one sorted search
+        null = np.sort(null)
+        table["p_cluster"] = (1 + len(null) - np.searchsorted(null, table["size"].to_numpy(), side="left")) / (1 + len(null))
+    return table
+
+
+def permutation_cluster_null(map_loader, subjects, scores, shape, n_perm=1000, cluster_p=0.001, seed=None,
+                             voxels=None, connectivity=26, max_memory_mb=512, prefetch_depth=0, prefetch_memory_mb=1024):
+    """
+    Largest cluster of voxels with correlation p < cluster_p in each of n_perm maps where the scores are
+    shuffled across subjects. A batch of permutations is one StreamingCorrelation with a score column per
+    permutation, so every map is read once per batch; batches keep the running sums within max_memory_mb.
+    map_loader(subject) returns (map, affine); subjects should be those with a map. voxels (flat indices)
+    restricts the analysis, e.g. to the voxels tested in the observed map. Returns the n_perm maximum sizes.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    present = np.isfinite(scores)
+    subjects = [s for s, ok in zip(subjects, present) if ok]
+    scores = scores[present]
+    voxels = np.arange(int(np.prod(shape))) if voxels is None else np.asarray(voxels)
+    permutations = permutation_indices(len(scores), n_perm, seed)
+
+    # Six running sums per voxel and permutation, plus about as much again for the temporaries of an update
+    batch = int(max(1, min(n_perm, max_memory_mb * 1024 ** 2 // (12 * 8 * max(1, len(voxels))))))
+    null = np.zeros(n_perm, dtype=int)
+    for b0 in range(0, n_perm, batch):
+        shuffled = scores[permutations[b0:b0 + batch]]  # (batch, subjects)
+        accumulator = StreamingCorrelation(len(voxels), len(shuffled))
+        for i, (subject, loaded, error) in enumerate(prefetch(subjects, map_loader, prefetch_depth, prefetch_memory_mb)):
+            if error is not None:
+                raise error
+            if loaded is None:
+                continue
+            data = np.asarray(loaded[0], dtype=np.float64).ravel()[voxels]
+            with stage("statistics", subject):
+                accumulator.update(np.where(data == 0, np.nan, data), shuffled[:, i])
+
+        with stage("statistics"):
+            _, p, _ = accumulator.result()
+            mask = np.zeros(int(np.prod(shape)), dtype=bool)
+            for j in range(p.shape[1]):
+                mask[voxels] = p[:, j] < cluster_p
+                _, sizes = label_clusters(mask.reshape(shape), connectivity)
+                null[b0 + j] = sizes.max() if sizes.size else 0
+    return null
+
+
+def cluster_inference(stat, p, affine, null, cluster_p=0.001, alpha=0.05, connectivity=26):
+    """
+    Clusters of voxels with p < cluster_p in an observed map, each with a p-value from the permutation null of
+    the largest cluster. Returns (cluster table, label map of the clusters with p_cluster < alpha).
+    """
+    labels, sizes = label_clusters(np.nan_to_num(p, nan=1.0) < cluster_p, connectivity)
+    table = cluster_table(labels, sizes, affine, stat=stat, null=null)
+    significant = np.zeros(len(sizes) + 1, dtype=bool)
+    if len(table):
+        significant[table.loc[table["p_cluster"] < alpha, "cluster"].to_numpy()] = True
+    return table, np.where(significant[labels], labels, 0).astype(np.int32)
+
+
+def correct_maps(paths, alpha=0.05, method="bh", pool=False, cluster_p=None, min_cluster=1, connectivity=26):
+    """
+    FDR per p map (writes <name>_q.nii.gz), or with pool one threshold over all maps (writes a
+    <name>_fdr.nii.gz mask). With cluster_p, voxels with p < cluster_p are also labelled into clusters of at
+    least min_cluster voxels (<name>_extent.nii.gz and .csv). Returns one summary row per map.
+    """
+    threshold = None
+    if pool:
+        with stage("statistics"):
+            threshold, m = fdr_threshold((np.asanyarray(nib.load(path).dataobj) for path in paths), alpha, method)
+        print(f"🔄 Pooled {method.upper()} over {len(paths)} maps ({m} tests): p <= {threshold:.3g}")
+
+    rows = []
+    for path in paths:
+        img = nib.load(path)
+        p = np.asanyarray(img.dataobj).astype(np.float64)
+        base = path[:-len("_p.nii.gz")] if path.endswith("_p.nii.gz") else path.split(".nii")[0]
+        with stage("statistics"):
+            if pool:
+                significant = p <= threshold
+                nib.Nifti1Image(significant.astype(np.uint8), img.affine).to_filename(f"{base}_fdr.nii.gz")
+            else:
+                q, significant = fdr(p, alpha, method)
+                nib.Nifti1Image(q.astype(np.float32), img.affine).to_filename(f"{base}_q.nii.gz")
+        row = {"map": path, "n_tests": int(np.isfinite(p).sum()), "n_significant_fdr": int(significant.sum())}
+
+        if cluster_p is not None:
+            labels, sizes = label_clusters(np.nan_to_num(p, nan=1.0) < cluster_p, connectivity)
+            kept = np.concatenate([[False], sizes >= min_cluster])
+            nib.Nifti1Image(np.where(kept[labels], labels, 0).astype(np.int32), img.affine).to_filename(f"{base}_extent.nii.gz")
+            cluster_table(labels, sizes, img.affine, min_size=min_cluster).to_csv(f"{base}_extent.csv", index=False)
+            row["n_clusters"] = int(kept.sum())
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FDR and cluster-extent correction of result tables and p maps")
+    parser.add_argument("inputs", nargs="+", help="result CSVs and/or NIfTI p maps (e.g. voxelwise_maps/*_p.nii.gz)")
+    parser.add_argument("--method", choices=["bh", "by"], default="bh", help="Benjamini-Hochberg or Benjamini-Yekutieli")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--p-column", default=None, help=f"p column of the tables (default: first of {', '.join(p_columns)})")
+    parser.add_argument("--pool", action="store_true", help="correct all maps as one family instead of map by map")
+    parser.add_argument("--cluster-p", type=float, default=None, help="also form clusters of voxels with p below this")
+    parser.add_argument("--min-cluster", type=int, default=1, help="smallest cluster (voxels) that is reported")
+    parser.add_argument("--connectivity", type=int, choices=sorted(structures), default=26)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+
+    maps = [path for path in args.inputs if path.endswith(".nii") or path.endswith(".nii.gz")]
+    for path in args.inputs:
+        if path in maps:
+            continue
+        if not os.path.exists(path):
+            print(f"❌ File not found: {path}")
+            continue
+        try:
+            corrected, column = correct_table(pd.read_csv(path), args.p_column, args.alpha, args.method)
+        except (KeyError, ValueError) as e:
+            print(f"❌ {path}: {e} — skipping FDR correction.")
+            continue
+        output_file = path.replace(".csv", "_fdr.csv")
+        corrected.to_csv(output_file, index=False)
+        print(f"✅ {args.method.upper()} FDR on '{column}' ({int(corrected['significant_fdr'].sum())} of {len(corrected)} "
+              f"significant) saved to {output_file}")
+
+    if maps:
+        summary = correct_maps(maps, args.alpha, args.method, args.pool, args.cluster_p, args.min_cluster, args.connectivity)
+        print(summary.to_string(index=False))
@@ -0,0 +1,168 @@
+"""
+Streaming reader for 4D NIfTI runs: memory-maps uncompressed files and reads voxel slabs in float32.
+Author: Emre Pelzer
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import nibabel as nib
+import numpy as np
+
+from profiling import stage
+
+# Gzipped runs are decompressed once into this folder (override with CRCI_NIFTI_CACHE); once it holds more
+# than CRCI_NIFTI_CACHE_GB, the least recently used runs are removed
+default_cache_dir = os.environ.get("CRCI_NIFTI_CACHE", os.path.join(tempfile.gettempdir(), "crci_nifti_cache"))
+max_cache_gb = float(os.environ.get("CRCI_NIFTI_CACHE_GB", 20))
+
+
+def add_cache_arguments(parser):
+    """Adds the shared --cache-dir / --clear-cache options to a script's parser."""
+    parser.add_argument("--cache-dir", default=None, help="where gzipped runs are decompressed once (default: system temp)")
+    parser.add_argument("--clear-cache", action="store_true", help="remove the decompressed runs from the cache and exit")
+
+
+def apply_cache_arguments(args):
+    """Carries out --clear-cache: empties the cache and ends the script."""
+    if args.clear_cache:
+        n_files, n_bytes = clear_cache(args.cache_dir)
+        print(f"✅ Removed {n_files} decompressed runs ({n_bytes / 1024 ** 3:.1f} GB) from {args.cache_dir or default_cache_dir}")
+        sys.exit(0)
+
+
+def uncompressed_path(path, cache_dir=None):
+    """Returns a path to an uncompressed copy of a NIfTI file, decompressing .nii.gz once into the cache."""
+    if not path.endswith(".gz"):
+        return path
+
+    cache_dir = cache_dir or default_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Named by path, then by size and mtime, so an updated input is decompressed again and replaces its old copy
+    stat = os.stat(path)
+    source = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:8]
+    cached = os.path.join(cache_dir, f"{source}_{version}_{os.path.basename(path)[:-3]}")
+
+    if os.path.exists(cached):
+        os.utime(cached)  # marks it as recently used
+        return cached
+
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    try:
+        with stage("decompress"), gzip.open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=16 * 1024 * 1024)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, cached)
+    _evict(cache_dir, cached, f"{source}_")
+    return cached
+
+
+def _evict(cache_dir, keep, source_prefix):
+    """Removes older copies of the same input, then least recently used runs while the cache is over max_cache_gb."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if entry == keep or name.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(entry)
+        except FileNotFoundError:  # removed by another worker meanwhile
+            continue
+        if name.startswith(source_prefix):
+            _remove(entry)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total = os.path.getsize(keep) + sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_cache_gb * 1024 ** 3:
+            break
+        _remove(entry)
+        total -= size
+
+
+def _remove(path):
+    # Runs still memory-mapped elsewhere stay readable on POSIX; where the OS refuses, the file is kept
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def clear_cache(cache_dir=None):
+    """Removes every decompressed run from the cache; returns the number of files and bytes freed."""
+    cache_dir = cache_dir or default_cache_dir
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+    n_files = n_bytes = 0
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.endswith(".tmp") or not os.path.isfile(entry):
+            continue
+        size = os.path.getsize(entry)
+        _remove(entry)
+        if not os.path.exists(entry):
+            n_files += 1
+            n_bytes += size
+    return n_files, n_bytes
+
+
+def open_image(path, cache_dir=None):
+    """Loads a NIfTI image whose data stays on disk (memory-mapped) until slabs are read."""
+    path = uncompressed_path(path, cache_dir)
+    with stage("load"):
+        return nib.load(path, mmap=True)
+
+
+def slab_size(img, max_chunk_mb=256, dtype=np.float32):
+    """Number of z-slices per slab so that one slab (all timepoints) stays under max_chunk_mb."""
+    x, y, z = img.shape[:3]
+    n_timepoints = img.shape[3] if len(img.shape) > 3 else 1
+    plane_bytes = x * y * n_timepoints * np.dtype(dtype).itemsize
+    return int(min(z, max(1, (max_chunk_mb * 1024 ** 2) // plane_bytes)))
+
+
+def iter_slabs(img, max_chunk_mb=256, dtype=np.float32):
+    """
+    Yields (z0, z1, slab) with slab of shape (x, y, z1 - z0, t) in the requested dtype.
+    NIfTI stores each volume contiguously, so a z-slab is read as one contiguous block per timepoint.
+    """
+    n_slices = img.shape[2]
+    step = slab_size(img, max_chunk_mb, dtype)
+    for z0 in range(0, n_slices, step):
+        z1 = min(z0 + step, n_slices)
+        with stage("read"):
+            slab = np.asarray(img.dataobj[:, :, z0:z1, ...]).astype(dtype, copy=False)
+        yield z0, z1, slab
+
+
+def read_voxels(img, voxels, dtype=np.float32):
+    """Reads the time series of a few voxels (list of (x, y, z)) -> array (n_voxels, t)."""
+    if len(voxels) == 0:
+        return np.zeros((0,) + tuple(img.shape[3:4] or (1,)), dtype=dtype)
+    with stage("read"):
+        return np.stack([np.asarray(img.dataobj[x, y, z, ...]).astype(dtype, copy=False) for x, y, z in voxels])
+
+
+def iter_volumes(img, max_chunk_mb=256, dtype=np.float32):
+    """Yields (t0, t1, block) with block of shape (x, y, z, t1 - t0): consecutive volumes, read contiguously."""
+    x, y, z, n_timepoints = img.shape[:4]
+    # A block read in another dtype is held twice for a moment: raw from the file and converted
+    source = img.get_data_dtype()
+    raw_bytes = source.itemsize if source != np.dtype(dtype) else 0
+    volume_bytes = x * y * z * (np.dtype(dtype).itemsize + raw_bytes)
+    step = int(min(n_timepoints, max(1, (max_chunk_mb * 1024 ** 2) // volume_bytes)))
+    for t0 in range(0, n_timepoints, step):
+        t1 = min(t0 + step, n_timepoints)
+        with stage("read"):
+            block = np.asarray(img.dataobj[..., t0:t1]).astype(dtype, copy=False)
+        yield t0, t1, block
+        del block  # so the previous block is not held while the next one is read
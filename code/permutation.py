@@ -0,0 +1,111 @@
+"""
+Vectorized permutation tests for group contrasts (Welch t) and correlations, with max-statistic FWE correction.
+Author: Emre Pelzer
+"""
+
+import numpy as np
+
+from mass_stats import correlate
+
+
+def add_permutation_arguments(parser, default_n_perm=5000):
+    """Adds the shared --n-perm / --perm-seed options to a script's argument parser."""
+    parser.add_argument("--n-perm", type=int, default=default_n_perm, help="number of label permutations (0 = off)")
+    parser.add_argument("--perm-seed", type=int, default=0, help="random seed, so permutation p-values are reproducible")
+
+
+def permutation_indices(n, n_perm, seed=None):
+    """Matrix of n_perm shuffles of range(n), one permutation per row -> (n_perm, n)."""
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(np.arange(n), (n_perm, 1)), axis=1)
+
+
+def welch_t(values, labels):
+    """
+    Welch t statistic (group True minus group False) for every column of values (n, k) and every
+    label row in labels (..., n) at once. NaN values are left out of their column only.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values - np.nanmean(values, axis=0)
+    valid = np.isfinite(values).astype(np.float64)
+    x = np.where(valid > 0, values, 0.0)
+
+    in_a = np.asarray(labels, dtype=np.float64)
+    in_b = 1.0 - in_a
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = []
+        for group in (in_a, in_b):
+            n = group @ valid
+            mean = (group @ x) / n
+            var = ((group @ x ** 2) - n * mean ** 2) / (n - 1)
+            stats.append((n, mean, np.maximum(var, 0)))
+        (n_a, mean_a, var_a), (n_b, mean_b, var_b) = stats
+        t = (mean_a - mean_b) / np.sqrt(var_a / n_a + var_b / n_b)
+    t[(n_a < 2) | (n_b < 2)] = np.nan
+    return t
+
+
+def _exceedances(abs_obs, null_abs):
+    """For one chunk of permutations: how often |null| >= observed per feature, and max |null| >= observed."""
+    null_abs = np.where(np.isnan(null_abs), -np.inf, null_abs)
+    abs_obs = abs_obs * (1 - 1e-12)  # relabelings equal to the observed one must count despite rounding
+    null_max = null_abs.reshape(len(null_abs), -1).max(axis=1)
+    uncorrected = np.sum(null_abs >= abs_obs, axis=0)
+    family = np.sum(null_max.reshape((-1,) + (1,) * abs_obs.ndim) >= abs_obs, axis=0)
+    return uncorrected, family
+
+
+def _finish(stat_obs, count_uncorrected, count_family, n_perm):
+    p_perm = (1 + count_uncorrected) / (1 + n_perm)
+    p_fwe = (1 + count_family) / (1 + n_perm)
+    p_perm[np.isnan(stat_obs)] = np.nan
+    p_fwe[np.isnan(stat_obs)] = np.nan
+    return p_perm, p_fwe
+
+
+def permutation_test_groups(values, labels, n_perm=5000, seed=None, chunk_size=1000):
+    """
+    Two-sided permutation test of the Welch t statistic for every column of values (subjects x features).
+    Labels are shuffled n_perm times and each chunk of shuffles is evaluated with a few matrix products.
+    Returns (t, p_perm, p_fwe); p_fwe uses the max |t| across features in each permutation.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    t_obs = welch_t(values, labels[None, :])[0]
+    abs_obs = np.abs(t_obs)
+
+    indices = permutation_indices(len(labels), n_perm, seed)
+    count_uncorrected = np.zeros(t_obs.shape)
+    count_family = np.zeros(t_obs.shape)
+    for start in range(0, n_perm, chunk_size):
+        null_abs = np.abs(welch_t(values, labels[indices[start:start + chunk_size]]))
+        uncorrected, family = _exceedances(abs_obs, null_abs)
+        count_uncorrected += uncorrected
+        count_family += family
+
+    p_perm, p_fwe = _finish(t_obs, count_uncorrected, count_family, n_perm)
+    return t_obs, p_perm, p_fwe
+
+
+def permutation_test_correlations(X, Y, n_perm=5000, seed=None, chunk_size=200):
+    """
+    Two-sided permutation test of Pearson r for every column pair of X (n, p) and Y (n, q).
+    Rows of Y are shuffled, and a chunk of shuffles is correlated in one batched call.
+    Returns (r, p_perm, p_fwe), each (p, q); p_fwe uses the max |r| over all pairs.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    r_obs, _ = correlate(X, Y)
+    abs_obs = np.abs(r_obs)
+
+    indices = permutation_indices(X.shape[0], n_perm, seed)
+    count_uncorrected = np.zeros(r_obs.shape)
+    count_family = np.zeros(r_obs.shape)
+    for start in range(0, n_perm, chunk_size):
+        r_null, _ = correlate(X, Y[indices[start:start + chunk_size]])
+        uncorrected, family = _exceedances(abs_obs, np.abs(r_null))
+        count_uncorrected += uncorrected
+        count_family += family
+
+    p_perm, p_fwe = _finish(r_obs, count_uncorrected, count_family, n_perm)
+    return r_obs, p_perm, p_fwe
@@ -0,0 +1,129 @@
+"""
+Out-of-sample prediction of cognitive scores from FC / SD-BOLD features with nested cross-validation.
+Author: Emre Pelzer
+
+Feature and target scaling are part of the model, so they are fitted on the training folds only. Scores are
+taken unscaled from cognitive_scores_clean.csv for that reason (cognitive_scores_normalized.csv is scaled on
+all subjects). Outer folds and permutation refits run in parallel with --jobs.
+"""
+
+import argparse
+import os
+import re
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.compose import TransformedTargetRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegressionCV, RidgeCV
+from sklearn.metrics import balanced_accuracy_score, mean_absolute_error, r2_score, roc_auc_score
+from sklearn.model_selection import KFold, StratifiedKFold, cross_val_predict, permutation_test_score
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+score_file = "cognitive_scores_clean.csv"
+feature_files = ["fc_features.csv", "sdbold_per_subject.csv"]
+output_csv = "prediction_results.csv"
+predictions_csv = "prediction_oof.csv"
+cvlt_cols = [f"CVLT{i}" for i in range(1, 14)]
+
+# scikit-learn 1.8 added l1_ratios / use_legacy_attributes to LogisticRegressionCV and warns until they are set
+sklearn_version = tuple(int(part) for part in re.match(r"(\d+)\.(\d+)", sklearn.__version__).groups())
+
+
+def load_features(paths):
+    """Subjects x features table joined over files; columns are prefixed with the file name when several are given."""
+    tables = []
+    for path in paths:
+        table = pd.read_csv(path).set_index("subject")
+        if len(paths) > 1:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            table = table.add_prefix(f"{stem}:")
+        tables.append(table)
+    return pd.concat(tables, axis=1, join="inner")
+
+
+def build_model(task, inner_folds, seed):
+    """
+    Imputation, scaling and the regularized model in one pipeline; the penalty is tuned inside each training
+    fold. RidgeCV tunes with its closed-form leave-one-out error and LogisticRegressionCV with a warm-started
+    path over C, so the inner loop costs about one fit instead of one per candidate and fold.
+    """
+    penalties = np.logspace(-3, 3, 13)
+    if task == "regression":
+        pipeline = make_pipeline(SimpleImputer(strategy="median"), StandardScaler(), RidgeCV(alphas=penalties))
+        return TransformedTargetRegressor(regressor=pipeline, transformer=StandardScaler())
+    inner_cv = StratifiedKFold(inner_folds, shuffle=True, random_state=seed)
+    # Log-loss tuning and the plain-L2 path, which are the defaults of newer scikit-learn, set explicitly
+    options = {"scoring": "neg_log_loss"}
+    if sklearn_version >= (1, 8):
+        options.update(l1_ratios=(0,), use_legacy_attributes=False)
+    return make_pipeline(SimpleImputer(strategy="median"), StandardScaler(),
+                         LogisticRegressionCV(Cs=penalties, cv=inner_cv, max_iter=5000, **options))
+
+
+def evaluate(task, y, predicted):
+    """
+    Out-of-fold performance: r, R² and MAE for regression; ROC AUC and balanced accuracy for classification.
+    These are descriptive only: out-of-fold predictions share training data, so a parametric p-value of r is not
+    valid (and r can be negative under shrinkage); use p_perm for inference.
+    """
+    if task == "regression":
+        r = np.corrcoef(y, predicted)[0, 1]
+        return {"r": r, "r2": r2_score(y, predicted), "mae": mean_absolute_error(y, predicted)}
+    return {"roc_auc": roc_auc_score(y, predicted[:, 1]), "balanced_accuracy": balanced_accuracy_score(y, predicted.argmax(axis=1))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nested cross-validated prediction of cognition")
+    parser.add_argument("--features", default=",".join(feature_files), help="comma-separated wide CSVs (subject + feature columns)")
+    parser.add_argument("--targets", default="CVLT_total,SES", help="comma-separated score columns; CVLT_total sums CVLT1-13")
+    parser.add_argument("--task", choices=["regression", "classification"], default="regression",
+                        help="classification predicts the median split of each target (low vs high)")
+    parser.add_argument("--outer-folds", type=int, default=5)
+    parser.add_argument("--inner-folds", type=int, default=5, help="inner folds for classification (ridge uses leave-one-out)")
+    parser.add_argument("--n-perm", type=int, default=1000, help="permutation refits for the null distribution (0 = off)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="outer folds / permutations fitted in parallel (-1 = all cores)")
+    args = parser.parse_args()
+
+    features = load_features(args.features.split(","))
+    scores = pd.read_csv(score_file).set_index("subject")
+    scores["CVLT_total"] = scores[cvlt_cols].sum(axis=1, min_count=len(cvlt_cols))
+    print(f"🔄 {features.shape[1]} features for {len(features)} subjects")
+
+    results = []
+    predictions = []
+    for target in args.targets.split(","):
+        data = features.join(scores[[target]], how="inner").dropna(subset=[target])
+        X = data[features.columns].to_numpy(dtype=np.float64)
+        y = data[target].to_numpy(dtype=np.float64)
+        if args.task == "classification":
+            y = (y >= np.median(y)).astype(int)  # 1 = high performers, same split as the group scripts
+
+        model = build_model(args.task, args.inner_folds, args.seed)
+        if args.task == "regression":
+            outer_cv = KFold(args.outer_folds, shuffle=True, random_state=args.seed)
+            predicted = cross_val_predict(model, X, y, cv=outer_cv, n_jobs=args.jobs)
+            scoring = "r2"
+        else:
+            outer_cv = StratifiedKFold(args.outer_folds, shuffle=True, random_state=args.seed)
+            predicted = cross_val_predict(model, X, y, cv=outer_cv, n_jobs=args.jobs, method="predict_proba")
+            scoring = "roc_auc"
+
+        row = {"target": target, "task": args.task, "n": len(y), "n_features": X.shape[1], **evaluate(args.task, y, predicted)}
+        if args.n_perm > 0:
+            # Every permutation refits the whole nested model, so the null includes the tuning
+            score, _, p_perm = permutation_test_score(model, X, y, cv=outer_cv, n_permutations=args.n_perm,
+                                                      scoring=scoring, n_jobs=args.jobs, random_state=args.seed)
+            row.update({f"cv_{scoring}": score, "p_perm": p_perm})
+        results.append(row)
+        print(f"✅ {target}: " + ", ".join(f"{k} = {v:.3f}" for k, v in row.items() if isinstance(v, float)))
+
+        oof = pd.DataFrame({"subject": data.index, "target": target, "observed": y})
+        oof["predicted"] = predicted if args.task == "regression" else predicted[:, 1]
+        predictions.append(oof)
+
+    pd.DataFrame(results).to_csv(output_csv, index=False)
+    pd.concat(predictions).to_csv(predictions_csv, index=False)
+    print(f"✅ Prediction results saved to: {output_csv} (out-of-fold predictions in {predictions_csv})")
@@ -0,0 +1,93 @@
+"""
+Background prefetching of subject files: the next few subjects are read (and gunzipped) in threads while the
+current one is processed.
+Author: Emre Pelzer
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from profiling import stage
+
+_end = object()
+
+
+def add_prefetch_arguments(parser):
+    """Adds the shared --prefetch / --prefetch-memory-mb options to a script's parser."""
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="subjects loaded ahead in background threads (0 = off; raise it on network drives)")
+    parser.add_argument("--prefetch-memory-mb", type=int, default=1024,
+                        help="memory the loaded-but-unprocessed subjects may take up")
+
+
+def nbytes(obj):
+    """Bytes held by the arrays in a (nested) tuple / list / dict of loaded data."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(nbytes(o) for o in obj.values())
+    return 0
+
+
+def prefetch(items, load, depth=2, max_memory_mb=1024, workers=None):
+    """
+    Yields (item, loaded, error) for every item in input order, where loaded = load(item) and error is the
+    exception load raised (loaded is then None). The next `depth` loads run in background threads: gzip
+    decompression and file reads release the GIL, so they overlap with the caller's work, and several reads in
+    flight hide the latency of network-mounted folders. Until the first load has finished (and its size is
+    known) only one subject is read ahead; after that a new load only starts while the current result, the
+    pending ones (running loads counted at the largest size seen) and the new one fit within max_memory_mb.
+    """
+    items = iter(items)
+    if depth <= 0:
+        for item in items:
+            try:
+                loaded = load(item)
+            except Exception as e:
+                yield item, None, e
+                continue
+            yield item, loaded, None
+        return
+
+    budget = max_memory_mb * 1024 ** 2
+    largest = None
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=workers or depth)
+
+    def held_ahead():
+        total = 0
+        for _, future in pending:
+            if not future.done():
+                total += largest
+            elif future.exception() is None:
+                total += nbytes(future.result())
+        return total
+
+    def top_up(current=0):
+        # One load ahead is always allowed; more only once sizes are known and they fit the budget
+        while len(pending) < depth and (not pending or (largest is not None and
+                                                        current + held_ahead() + largest <= budget)):
+            item = next(items, _end)
+            if item is _end:
+                return
+            pending.append((item, pool.submit(load, item)))
+
+    try:
+        top_up()
+        while pending:
+            item, future = pending.popleft()
+            with stage("wait"):
+                try:
+                    loaded, error = future.result(), None
+                except Exception as e:
+                    loaded, error = None, e
+            if error is None:
+                largest = max(largest or 0, nbytes(loaded))
+            top_up(nbytes(loaded))  # the next loads run while the caller works on this one
+            yield item, loaded, error
+            loaded = None
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
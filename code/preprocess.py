@@ -0,0 +1,248 @@
+"""
+Preprocesses raw BIDS rs-fMRI runs in native space: rigid realignment of every volume to the middle volume,
+then Gaussian smoothing (6 mm FWHM) as three 1D convolutions, saved as preprocessed/{subject}_task-rest_mc.nii.gz.
+Author: Emre Pelzer
+
+Realignment is Gauss-Newton on the reference's own gradients (inverse compositional), so the Jacobian and its
+pseudo-inverse are computed once per run and each iteration only samples the moving volume at a subset of brain
+voxels. Every output gets a .json sidecar with the input fingerprint, parameters and code version; subjects whose
+sidecar still matches are skipped, so rerunning only processes new or changed runs.
+"""
+
+import argparse
+import json
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.spatial.transform import Rotation
+
+from checkpoint import atomic_write_json, code_version, input_fingerprint
+from manifest import subject_id as parse_subject
+from profiling import add_profile_argument, enable, stage
+from subject_pool import add_pool_arguments, run_subjects
+
+bids_dir = "../data"
+output_dir = "preprocessed"
+run_suffix = "task-rest_dir-PA_bold.nii.gz"
+fwhm = 6.0  # mm
+sample_stride = 2  # every 2nd brain voxel per axis is used to estimate the motion
+max_iterations = 20
+tolerance = 1e-4  # mm / rad
+interp_order = 3  # spline order of the final reslicing
+motion_columns = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+
+
+def find_runs(root, suffix=run_suffix):
+    """{subject: path} of all resting-state runs below a BIDS folder (first session if there are several)."""
+    runs = {}
+    for folder, _, files in sorted(os.walk(root)):
+        for fname in sorted(files):
+            if not (fname.startswith("sub-") and fname.endswith(suffix)):
+                continue
+            subject = parse_subject(fname, f"_{suffix}")
+            if subject in runs:
+                print(f"⚠️ {subject}: several runs found, using {os.path.basename(runs[subject])}")
+                continue
+            runs[subject] = os.path.join(folder, fname)
+    return runs
+
+
+def sidecar_path(path):
+    """BIDS JSON sidecar next to a .nii.gz run."""
+    return path[:-len(".nii.gz")] + ".json"
+
+
+def rigid_matrix(params, center):
+    """4x4 world-space rigid transform: rotation (rotation vector, rad) about center, then translation (mm)."""
+    matrix = np.eye(4)
+    matrix[:3, :3] = Rotation.from_rotvec(params[3:]).as_matrix()
+    matrix[:3, 3] = center + params[:3] - matrix[:3, :3] @ center
+    return matrix
+
+
+def rigid_params(matrix, center):
+    """Inverse of rigid_matrix: (tx, ty, tz, rx, ry, rz) of a rigid transform about center."""
+    rotation = matrix[:3, :3]
+    return np.concatenate([matrix[:3, 3] - center + rotation @ center, Rotation.from_matrix(rotation).as_rotvec()])
+
+
+class Realigner:
+    """
+    Rigid registration of volumes to one reference volume. The Jacobian of the reference at the sample voxels,
+    d ref / d (translation, rotation), does not change between iterations or volumes, so it is inverted once.
+    """
+
+    def __init__(self, reference, affine, stride=sample_stride):
+        self.affine = affine
+        self.shape = reference.shape
+        inv_linear = np.linalg.inv(affine[:3, :3])
+
+        # Sample voxels: brain (above the mean intensity), away from the edge, every stride-th voxel
+        mask = reference > reference.mean()
+        mask[[0, -1]] = mask[:, [0, -1]] = mask[:, :, [0, -1]] = False
+        grid = np.zeros_like(mask)
+        grid[::stride, ::stride, ::stride] = True
+        self.voxels = np.argwhere(mask & grid).T.astype(np.float64)  # (3, n)
+        world = affine[:3, :3] @ self.voxels + affine[:3, 3:4]
+        self.center = world.mean(axis=1)
+        self.world = np.vstack([world, np.ones(world.shape[1])])
+
+        # World-space gradient of the reference; d/d rotation of ref(x + w x (x - c)) is (x - c) x grad
+        ijk = tuple(self.voxels.astype(int))
+        gradient = inv_linear.T @ np.stack([g[ijk] for g in np.gradient(reference)])
+        rotation = np.cross((world - self.center[:, None]).T, gradient.T).T
+        jacobian = np.vstack([gradient, rotation]).T  # (n, 6)
+        self.reference = reference[ijk]
+        self.pinv = np.linalg.pinv(jacobian)
+
+    def sample(self, volume, matrix, order=1):
+        """Values of volume at the transformed sample voxels."""
+        coords = np.linalg.solve(self.affine, matrix @ self.world)[:3]
+        return ndimage.map_coordinates(volume, coords, order=order, mode="nearest")
+
+    def fit(self, volume, matrix=None):
+        """
+        World-space rigid transform M so that volume(M x) matches the reference at x.
+        Each step solves for the small reference motion D explaining the residual and composes M <- M D^-1.
+        """
+        matrix = np.eye(4) if matrix is None else matrix.copy()
+        for _ in range(max_iterations):
+            residual = self.sample(volume, matrix) - self.reference
+            update = self.pinv @ residual
+            matrix = matrix @ np.linalg.inv(rigid_matrix(update, self.center))
+            if np.abs(update).max() < tolerance:
+                break
+        return matrix
+
+    def reslice(self, volume, matrix, order=interp_order):
+        """Volume resampled onto the reference grid with the fitted transform."""
+        voxel_matrix = np.linalg.solve(self.affine, matrix @ self.affine)
+        return ndimage.affine_transform(volume, voxel_matrix, order=order, mode="nearest")
+
+
+def smooth_volume(volume, sigmas):
+    """Separable Gaussian smoothing in place: one 1D convolution per axis (sigmas in voxels)."""
+    for axis, sigma in enumerate(sigmas):
+        if sigma > 0:
+            ndimage.gaussian_filter1d(volume, sigma, axis=axis, output=volume)
+    return volume
+
+
+def framewise_displacement(motion, radius=50.0):
+    """Power et al. FD: summed absolute volume-to-volume change, rotations as arc length on a 50 mm sphere."""
+    delta = np.abs(np.diff(motion, axis=0))
+    delta[:, 3:] *= radius
+    return np.concatenate([[0.0], delta.sum(axis=1)])
+
+
+def preprocess_subject(subject_id, run_path, out_path, fwhm=fwhm, params=None):
+    """Realigns and smooths one run; writes the output run, its motion table and its sidecar."""
+    with stage("load"):
+        img = nib.load(run_path)
+        data = np.asarray(img.dataobj, dtype=np.float32)
+    affine = img.affine
+    n_timepoints = data.shape[3]
+
+    with stage("realign"):
+        reference = data[..., n_timepoints // 2].astype(np.float64)
+        realigner = Realigner(reference, affine)
+        motion = np.zeros((n_timepoints, 6))
+        # Head motion is smooth in time, so each fit starts from a neighbouring volume's transform
+        order = list(range(n_timepoints // 2, n_timepoints)) + list(range(n_timepoints // 2 - 1, -1, -1))
+        matrices = {}
+        for t in order:
+            start = matrices.get(t - 1 if t > n_timepoints // 2 else t + 1)
+            matrices[t] = realigner.fit(data[..., t], start)
+            motion[t] = rigid_params(matrices[t], realigner.center)
+            data[..., t] = realigner.reslice(data[..., t], matrices[t])
+
+    with stage("smooth"):
+        sigma_mm = fwhm / np.sqrt(8 * np.log(2))
+        sigmas = sigma_mm / np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+        for t in range(n_timepoints):
+            smooth_volume(data[..., t], sigmas)
+
+    with stage("save"):
+        out_img = nib.Nifti1Image(data, affine, img.header)
+        out_img.set_data_dtype(np.float32)
+        sidecar = sidecar_path(run_path)
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                tr = json.load(f).get("RepetitionTime")
+            if tr:
+                out_img.header.set_zooms(out_img.header.get_zooms()[:3] + (float(tr),))
+        tmp_path = f"{out_path[:-len('.nii.gz')]}.{os.getpid()}.tmp.nii.gz"
+        try:
+            out_img.to_filename(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, out_path)
+
+        table = pd.DataFrame(motion, columns=motion_columns)
+        table["framewise_displacement"] = framewise_displacement(motion)
+        base = out_path[:-len("_mc.nii.gz")]
+        table.to_csv(f"{base}_motion.tsv", sep="\t", index=False)
+        atomic_write_json(f"{out_path[:-len('.nii.gz')]}.json", params)
+
+    return float(table["framewise_displacement"].mean()), float(np.abs(motion[:, :3]).max())
+
+
+def run_params(run_path, fwhm, version):
+    """What the output depends on: the input run and its BIDS sidecar, the smoothing and the code."""
+    sidecar = sidecar_path(run_path)
+    return {"input": os.path.abspath(run_path), "fingerprint": input_fingerprint(run_path),
+            "sidecar": input_fingerprint(sidecar) if os.path.exists(sidecar) else None,
+            "fwhm": fwhm, "code": version}
+
+
+def is_current(out_path, params):
+    """True when the output exists and its sidecar was written with exactly these parameters."""
+    json_path = f"{out_path[:-len('.nii.gz')]}.json"
+    if not (os.path.exists(out_path) and os.path.exists(json_path)):
+        return False
+    with open(json_path) as f:
+        return json.load(f) == params
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Motion correction and smoothing of raw BIDS rs-fMRI runs")
+    parser.add_argument("--bids-dir", default=bids_dir)
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--fwhm", type=float, default=fwhm, help="smoothing kernel in mm (0 = off)")
+    parser.add_argument("--subjects", default=None, help="comma-separated subject IDs (default: all)")
+    parser.add_argument("--force", action="store_true", help="rerun subjects whose outputs are up to date")
+    add_pool_arguments(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable(args.profile)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    runs = find_runs(args.bids_dir)
+    if args.subjects:
+        wanted = set(args.subjects.split(","))
+        runs = {s: p for s, p in runs.items() if s in wanted}
+    if not runs:
+        if os.path.isdir(args.output_dir) and any(f.endswith("_mc.nii.gz") for f in os.listdir(args.output_dir)):
+            print(f"⚠️ No raw *_{run_suffix} runs in {args.bids_dir}, keeping the runs in {args.output_dir}")
+            raise SystemExit(0)
+        raise SystemExit(f"❌ No *_{run_suffix} runs found in {args.bids_dir}")
+
+    version = code_version(__file__)
+    tasks = []
+    for subject_id, run_path in runs.items():
+        out_path = os.path.join(args.output_dir, f"{subject_id}_task-rest_mc.nii.gz")
+        params = run_params(run_path, args.fwhm, version)
+        if not args.force and is_current(out_path, params):
+            print(f"⏭️ {subject_id} up to date")
+            continue
+        tasks.append((subject_id, (subject_id, run_path, out_path, args.fwhm, params)))
+
+    if tasks:
+        results, _ = run_subjects(preprocess_subject, tasks, jobs=args.jobs, max_memory_gb=args.max_memory_gb)
+        for subject_id, (mean_fd, max_shift) in results.items():
+            print(f"✔️ {subject_id}: mean FD {mean_fd:.3f} mm, max translation {max_shift:.2f} mm")
+    print(f"✅ {len(runs) - len(tasks)} subjects up to date, {len(tasks)} preprocessed into: {args.output_dir}")
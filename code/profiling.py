@@ -0,0 +1,211 @@
+"""
+Lightweight per-subject / per-stage timing and memory profiling for the pipeline hot paths.
+Author: Emre Pelzer
+
+Enable with the CRCI_PROFILE environment variable (or a script's --profile flag) set to an output file:
+a .json file is written as a Chrome trace (open in chrome://tracing or ui.perfetto.dev), anything else
+as CSV. Every event records the resident memory at the start and end of the stage and the peak within it:
+on Linux the kernel's high-water mark (VmHWM) is reset when a stage starts; elsewhere the peak is only known
+when the stage raised the process's lifetime maximum. Worker processes hand their events back through subject_pool; events of several scripts run
+with the same file (e.g. by run_pipeline.py) are appended to it.
+"""
+
+import atexit
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+env_var = "CRCI_PROFILE"
+columns = ["script", "subject", "stage", "pid", "start", "seconds", "rss_start_mb", "rss_end_mb", "stage_peak_rss_mb"]
+
+_events = []
+current_subject = None
+
+# Peak trackers of the stages open right now (in any thread); the high-water mark is per process
+_open_stages = []
+_lock = threading.Lock()
+
+
+def enabled():
+    return bool(os.environ.get(env_var))
+
+
+def add_profile_argument(parser):
+    """Adds --profile to a script's argument parser; call enable(args.profile) after parsing."""
+    parser.add_argument("--profile", default=None,
+                        help=f"write a per-stage profile to this .csv or .json (Chrome trace) file (or set {env_var})")
+
+
+def enable(path):
+    """Turns profiling on for this process and the workers it starts."""
+    if path:
+        os.environ[env_var] = os.path.abspath(path)
+        _register_writer()
+
+
+def _proc_status_mb(field):
+    """A memory field of /proc/self/status (VmRSS, VmHWM) in MB, or None where there is no /proc."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _rss_mb():
+    """Current resident memory in MB (psutil where there is no /proc), or None."""
+    rss = _proc_status_mb("VmRSS")
+    if rss is None:
+        try:
+            import psutil
+            rss = round(psutil.Process().memory_info().rss / 1024 ** 2, 1)
+        except ImportError:
+            pass
+    return rss
+
+
+def _lifetime_peak_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round((peak if sys.platform == "darwin" else peak * 1024) / 1024 ** 2, 1)
+
+
+def _reset_peak():
+    """Restarts the kernel's high-water mark so it covers only what follows; False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _fold_peak():
+    # Called with _lock held: the high-water mark so far counts for every open stage
+    high_water = _proc_status_mb("VmHWM")
+    for tracker in _open_stages:
+        if tracker["peak"] is None or (high_water is not None and high_water > tracker["peak"]):
+            tracker["peak"] = high_water
+
+
+@contextmanager
+def stage(name, subject=None):
+    """Times the enclosed block as one event; does nothing unless profiling is enabled."""
+    if not enabled():
+        yield
+        return
+    with _lock:
+        _fold_peak()  # before the reset, so enclosing stages keep their peak so far
+        tracker = {"peak": None, "exact": _reset_peak(), "lifetime": _lifetime_peak_mb()}
+        _open_stages.append(tracker)
+    rss_start = _rss_mb()
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        rss_end = _rss_mb()
+        with _lock:
+            _fold_peak()
+            _open_stages.remove(tracker)
+        if tracker["exact"]:
+            peak = tracker["peak"]
+        else:
+            # Without a resettable high-water mark the peak is only known if this stage set a new lifetime peak
+            lifetime = _lifetime_peak_mb()
+            peak = lifetime if lifetime is not None and lifetime > (tracker["lifetime"] or 0) else None
+        _events.append({
+            "script": os.path.basename(sys.argv[0]),
+            "subject": subject or current_subject or "",
+            "stage": name,
+            "pid": os.getpid(),
+            "start": start,
+            "seconds": seconds,
+            "rss_start_mb": rss_start,
+            "rss_end_mb": rss_end,
+            "stage_peak_rss_mb": peak,
+        })
+
+
+def take_events():
+    """Returns and clears the events recorded in this process (used to ship them out of workers)."""
+    events = list(_events)
+    _events.clear()
+    return events
+
+
+def merge(events):
+    _events.extend(events)
+
+
+def summarize(events):
+    """Total seconds and the largest in-stage peak RSS per stage, slowest first."""
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event["stage"], {"calls": 0, "seconds": 0.0, "stage_peak_rss_mb": 0.0})
+        total["calls"] += 1
+        total["seconds"] += event["seconds"]
+        total["stage_peak_rss_mb"] = max(total["stage_peak_rss_mb"], event["stage_peak_rss_mb"] or 0.0)
+    return dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"]))
+
+
+def write(path, events):
+    """Appends events to a CSV file or a Chrome trace JSON file."""
+    if path.endswith(".json"):
+        trace = {"traceEvents": []}
+        if os.path.exists(path):
+            with open(path) as f:
+                trace = json.load(f)
+        for event in events:
+            trace["traceEvents"].append({
+                "name": event["stage"], "cat": event["script"], "ph": "X", "pid": event["pid"], "tid": 0,
+                "ts": int(event["start"] * 1e6), "dur": int(event["seconds"] * 1e6),
+                "args": {key: event[key] for key in ("subject", "rss_start_mb", "rss_end_mb", "stage_peak_rss_mb")},
+            })
+        with open(path, "w") as f:
+            json.dump(trace, f)
+    else:
+        new_file = not os.path.exists(path)
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            if new_file:
+                writer.writeheader()
+            for event in events:
+                writer.writerow({**event, "start": round(event["start"], 6), "seconds": round(event["seconds"], 6)})
+
+
+def _write_at_exit():
+    events = take_events()
+    if not events or not enabled():
+        return
+    path = os.environ[env_var]
+    write(path, events)
+    print(f"\n⏱️ Profile ({len(events)} events) written to: {path}")
+    for name, total in summarize(events).items():
+        print(f"   {name:<14} {total['calls']:>5} calls  {total['seconds']:>9.2f} s  peak RSS {total['stage_peak_rss_mb']} MB")
+
+
+_writer_registered = False
+
+
+def _register_writer():
+    global _writer_registered
+    if not _writer_registered and multiprocessing.parent_process() is None:
+        atexit.register(_write_at_exit)
+        _writer_registered = True
+
+
+# Only the main process writes; workers return their events to it
+if enabled():
+    _register_writer()
@@ -0,0 +1,153 @@
+"""
+Single-pass multi-ROI extraction: sphere voxel indices per image grid, then one gather for all seeds.
+Author: Emre Pelzer
+"""
+
+import numpy as np
+
+from mask_cache import gather, grid_key
+from nifti_reader import iter_volumes
+
+# Sphere indices already computed, keyed by (grid, radius, seed coordinates)
+_sphere_cache = {}
+
+
+def sphere_indices(coords, radius, affine, shape):
+    """
+    Flat C-order voxel indices of a sphere (radius in mm) around every coordinate in coords {name: [x, y, z]}.
+    Only the bounding box of each sphere is searched. Like NiftiSpheresMasker, the voxel nearest to the
+    centre is always included, so small spheres on coarse grids never come out empty.
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    shape = np.asarray(shape[:3])
+    inv_affine = np.linalg.inv(affine)
+    voxel_sizes = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    half_width = np.ceil(radius / voxel_sizes).astype(int) + 1
+
+    indices = {}
+    for name, coord in coords.items():
+        center = inv_affine[:3, :3] @ np.asarray(coord, dtype=np.float64) + inv_affine[:3, 3]
+        nearest = np.round(center).astype(int)
+        lo = np.clip(nearest - half_width, 0, shape)
+        hi = np.clip(nearest + half_width + 1, 0, shape)
+
+        box = np.stack(np.meshgrid(*[np.arange(l, h) for l, h in zip(lo, hi)], indexing="ij"), axis=-1).reshape(-1, 3)
+        world = box @ affine[:3, :3].T + affine[:3, 3]
+        inside = ((world - np.asarray(coord)) ** 2).sum(axis=1) <= radius ** 2
+        voxels = box[inside]
+
+        if np.all((nearest >= 0) & (nearest < shape)):
+            voxels = np.unique(np.vstack([voxels, nearest[None, :]]), axis=0)
+
+        indices[name] = np.ravel_multi_index(voxels.T, tuple(shape)) if len(voxels) else np.empty(0, dtype=np.int64)
+    return indices
+
+
+def sphere_indices_for(img, coords, radius):
+    """sphere_indices for the grid of img, computed once per grid."""
+    key = (grid_key(img), float(radius), tuple((name, tuple(c)) for name, c in coords.items()))
+    if key not in _sphere_cache:
+        _sphere_cache[key] = sphere_indices(coords, radius, img.affine, img.shape)
+    return _sphere_cache[key]
+
+
+def roi_stats(data, indices, stats=("mean",)):
+    """
+    Summarizes a 3D map in every ROI at once. All ROI voxels are gathered in one fancy index and
+    reduced per ROI with np.add.reduceat. Supported stats: mean, median, std.
+    Returns {roi: {stat: value}}; empty ROIs give NaN.
+    """
+    names = [name for name in indices if len(indices[name])]
+    result = {name: {stat: np.nan for stat in stats} for name in indices}
+    if not names:
+        return result
+
+    sizes = np.array([len(indices[name]) for name in names])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    values = gather(data, np.concatenate([indices[name] for name in names])).astype(np.float64)
+
+    sums = np.add.reduceat(values, starts)
+    means = sums / sizes
+    if "std" in stats:
+        stds = np.sqrt(np.add.reduceat((values - np.repeat(means, sizes)) ** 2, starts) / sizes)
+
+    for i, name in enumerate(names):
+        if "mean" in stats:
+            result[name]["mean"] = means[i]
+        if "std" in stats:
+            result[name]["std"] = stds[i]
+        if "median" in stats:
+            result[name]["median"] = np.median(values[starts[i]:starts[i] + sizes[i]])
+    return result
+
+
+def roi_timeseries(img, indices, max_chunk_mb=256):
+    """
+    Mean time series of every ROI -> array (n_rois, t), in the order of indices.
+    Volumes are streamed in blocks (see nifti_reader.iter_volumes); the voxels of all ROIs are gathered
+    together and averaged per ROI with np.add.reduceat. Empty ROIs give NaN.
+    """
+    names = list(indices)
+    sizes = np.array([len(indices[name]) for name in names])
+    nonempty = sizes > 0
+    starts = np.concatenate([[0], np.cumsum(sizes[nonempty])[:-1]])
+    all_indices = np.concatenate([indices[name] for name in names]).astype(np.int64)
+
+    ts = np.full((len(names), img.shape[3]), np.nan)
+    if not nonempty.any():
+        return ts
+    for t0, t1, block in iter_volumes(img, max_chunk_mb=max_chunk_mb):
+        values = block.reshape(-1, t1 - t0)[all_indices].astype(np.float64)
+        ts[nonempty, t0:t1] = np.add.reduceat(values, starts, axis=0) / sizes[nonempty, None]
+    return ts
+
+
+def parcel_means(values, labels, n_labels):
+    """
+    Mean of values (V,) or (V, t) per label for all parcels at once with np.bincount, instead of one mask
+    per parcel. labels is a flat label per voxel; returns (n_labels,) or (n_labels, t), NaN for empty labels.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(labels, minlength=n_labels).astype(np.float64)
+    if values.ndim == 1:
+        sums = np.bincount(labels, weights=values, minlength=n_labels)
+    else:
+        # One bincount over (label, timepoint) pairs covers every parcel and timepoint
+        n_timepoints = values.shape[1]
+        bins = (labels[:, None] * n_timepoints + np.arange(n_timepoints)).ravel()
+        sums = np.bincount(bins, weights=values.ravel(), minlength=n_labels * n_timepoints)
+        sums = sums.reshape(n_labels, n_timepoints)
+        counts = counts[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def parcel_stats(data, labels, names, stats=("mean",)):
+    """roi_stats for a parcellation: labels is a flat label per voxel of data, names {label: name}."""
+    values = np.asarray(data, dtype=np.float64).ravel()
+    n_labels = max(int(labels.max()), max(names)) + 1
+    counts = np.bincount(labels, minlength=n_labels)
+    means = parcel_means(values, labels, n_labels)
+
+    columns = {"mean": means}
+    if "std" in stats:
+        squares = np.bincount(labels, weights=(values - np.nan_to_num(means)[labels]) ** 2, minlength=n_labels)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            columns["std"] = np.where(counts > 0, np.sqrt(squares / counts), np.nan)
+    if "median" in stats:
+        # Sort by (label, value) once; each parcel's median sits in the middle of its run
+        sorted_values = values[np.lexsort((values, labels))]
+        starts = np.cumsum(counts) - counts
+        lo = np.clip(starts + (counts - 1) // 2, 0, len(values) - 1)
+        hi = np.clip(starts + counts // 2, 0, len(values) - 1)
+        columns["median"] = np.where(counts > 0, (sorted_values[lo] + sorted_values[hi]) / 2, np.nan)
+
+    return {name: {stat: columns[stat][label] for stat in stats} for label, name in names.items()}
+
+
+def parcel_timeseries(img, labels, n_labels, max_chunk_mb=256):
+    """Mean time series of every label -> array (n_labels, t), streamed in blocks of volumes."""
+    ts = np.full((n_labels, img.shape[3]), np.nan)
+    for t0, t1, block in iter_volumes(img, max_chunk_mb=max_chunk_mb):
+        ts[:, t0:t1] = parcel_means(block.reshape(-1, t1 - t0), labels, n_labels)
+    return ts
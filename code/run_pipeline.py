@@ -0,0 +1,241 @@
+"""
+Runs the analysis scripts as dependency-ordered stages and reruns only what is stale.
+Author: Emre Pelzer
+
+A stage is stale when its script (or a local module it imports), its parameters or the content of one of
+its inputs changed since the last successful run, or when an output is missing. Per-subject stages are
+tracked per subject and only the stale subjects are passed to the script with --subjects.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from checkpoint import local_sources
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = ".pipeline_state.json"
+bids_dir = "../data"
+preproc_dir = "preprocessed"
+run_suffix = "_mc.nii.gz"
+
+
+def fc_subject_done(subject):
+    """A subject counts as extracted once the feature store holds at least one of its maps."""
+    from feature_store import FeatureStore
+
+    if not os.path.exists("features_fc.h5"):
+        return False
+    with FeatureStore("features_fc.h5", mode="r") as store:
+        return bool(store.seeds(subject))
+
+
+# Stages in execution order. Inputs/outputs are relative to the working directory; {subject} is
+# filled in for per-subject stages, whose input is the subject's preprocessed run.
+stages = [
+    {"name": "preprocess", "script": "preprocess.py", "jobs": True,
+     "inputs": [bids_dir], "outputs": [preproc_dir]},
+    {"name": "cognitive_columns", "script": "extract_cognitive_columns.py",
+     "inputs": ["cognitive_scores.csv"], "outputs": ["cognitive_scores_clean.csv"]},
+    {"name": "normalize_scores", "script": "normalize_scores.py",
+     "inputs": ["cognitive_scores_clean.csv"], "outputs": ["cognitive_scores_normalized.csv"]},
+    {"name": "seed_masks", "script": "generate_seed_masks.py", "args": ["--target-dir", preproc_dir, "--no-nifti"],
+     "inputs": [preproc_dir], "outputs": ["seed_masks"]},
+    {"name": "sdbold_maps", "script": "generate_sdbold_maps.py", "per_subject": True,
+     "args": ["--preproc-dir", preproc_dir, "--output-dir", "features_sdbold"],
+     "outputs": ["features_sdbold/{subject}_sdbold.nii.gz"]},
+    {"name": "fc_maps", "script": "extract_fc.py", "per_subject": True,
+     "args": ["--preproc-dir", preproc_dir, "--store", "features_fc.h5"], "force_args": ["--no-resume"],
+     "outputs": ["features_fc.h5"], "subject_done": fc_subject_done},
+    {"name": "roi_connectivity", "script": "extract_roi_connectivity.py",
+     "inputs": [preproc_dir], "outputs": ["fc_edges.csv"]},
+    {"name": "dynamic_fc", "script": "extract_dynamic_fc.py",
+     "inputs": [preproc_dir], "outputs": ["fc_dynamic.csv"]},
+    {"name": "fc_features", "script": "generate_fc_features.py",
+     "inputs": ["features_fc.h5"], "outputs": ["fc_features.csv"]},
+    {"name": "sdbold_per_subject", "script": "generate_sdbold_per_subject_resampled.py",
+     "inputs": ["features_sdbold", "seed_masks"], "outputs": ["sdbold_per_subject.csv"]},
+    {"name": "fc_cognition", "script": "analyze_fc_cognition.py",
+     "inputs": ["features_fc.h5", "cognitive_scores_normalized.csv"], "outputs": ["fc_correlation_results.csv"]},
+    {"name": "sdbold_cognition", "script": "correlate_sdbold_scores.py",
+     "inputs": ["features_sdbold", "cognitive_scores_normalized.csv"],
+     "outputs": ["sdbold_roi_values.csv", "sdbold_correlation_results.csv"]},
+    {"name": "fc_groups", "script": "analyze_fc_cvlt_groups.py", "perm": True,
+     "inputs": ["features_fc.h5", "cognitive_scores_normalized.csv"], "outputs": ["fc_cvlt_group_comparison.csv"]},
+    {"name": "sdbold_groups", "script": "analyze_sdbold_cvlt_groups.py", "perm": True,
+     "inputs": ["features_sdbold", "cognitive_scores_normalized.csv"], "outputs": ["sdbold_cvlt_group_comparison.csv"]},
+    {"name": "prediction", "script": "predict_cognition.py",
+     "inputs": ["fc_features.csv", "sdbold_per_subject.csv", "cognitive_scores_clean.csv"],
+     "outputs": ["prediction_results.csv", "prediction_oof.csv"]},
+    {"name": "glm", "script": "glm_analysis.py",
+     "inputs": ["features_fc.h5", "sdbold_per_subject.csv", "cognitive_scores_normalized.csv"],
+     "outputs": ["fc_glm_results.csv", "sdbold_glm_results.csv"]},
+    {"name": "fdr", "script": "apply_fdr_correction.py",
+     "inputs": ["fc_correlation_results.csv", "sdbold_correlation_results.csv", "fc_glm_results.csv", "sdbold_glm_results.csv"],
+     "outputs": ["fc_correlation_results_fdr.csv", "sdbold_correlation_results_fdr.csv",
+                 "fc_glm_results_fdr.csv", "sdbold_glm_results_fdr.csv"]},
+    {"name": "plots", "script": "plots.py",
+     "inputs": ["fc_correlation_results_fdr.csv", "sdbold_correlation_results_fdr.csv", "fc_cvlt_group_comparison.csv",
+                "fc_features.csv", "sdbold_per_subject.csv", "cognitive_scores_clean.csv"],
+     "outputs": ["output"]},
+]
+
+
+class ContentHasher:
+    """SHA-256 of file contents, remembered by (size, mtime) so unchanged files are not read again."""
+
+    def __init__(self, known):
+        self.known = known
+
+    def file(self, path):
+        stat = os.stat(path)
+        cached = self.known.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                digest.update(block)
+        self.known[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def path(self, path):
+        """Hash of a file, or of every file below a directory; missing paths hash as 'missing'."""
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    digest.update(os.path.relpath(full, path).encode())
+                    digest.update(self.file(full).encode())
+            return digest.hexdigest()
+        if os.path.exists(path):
+            return self.file(path)
+        return "missing"
+
+
+def signature(hasher, stage, params, inputs):
+    # The script plus every local module it imports, so engine changes invalidate stages
+    digest = hashlib.sha256()
+    for path in sorted(local_sources(os.path.join(code_dir, stage["script"]))):
+        digest.update(hasher.file(path).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for path in inputs:
+        digest.update(path.encode())
+        digest.update(hasher.path(path).encode())
+    return digest.hexdigest()
+
+
+def discover_runs():
+    """{subject: path of the preprocessed run}, parsed the same way as in the scripts."""
+    from manifest import scan
+
+    return scan(preproc_dir, run_suffix)
+
+
+def stage_command(stage, params, subjects=None):
+    command = [sys.executable, os.path.join(code_dir, stage["script"])] + stage.get("args", []) + params
+    if subjects is not None:
+        command += ["--subjects", ",".join(subjects)]
+    return command
+
+
+def save_state(state):
+    tmp_path = f"{state_file}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, state_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental pipeline runner")
+    parser.add_argument("--workdir", default=code_dir, help="folder the scripts run in (where the data files live)")
+    parser.add_argument("--only", default=None, help="comma-separated stage names to consider")
+    parser.add_argument("--force", default=None, help="comma-separated stage names to rerun regardless of state")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stale stages and subjects")
+    parser.add_argument("--fisher-z", action="store_true", help="passed to extract_fc.py")
+    parser.add_argument("--n-perm", type=int, default=None, help="passed to the group comparison scripts")
+    parser.add_argument("--jobs", type=int, default=1, help="passed to per-subject stages and preprocessing (not part of the hash)")
+    parser.add_argument("--profile", default=None, help="collect a per-stage profile of every script run into this .csv/.json file")
+    args = parser.parse_args()
+
+    # The scripts pick the profile path up from the environment and append their events to it
+    if args.profile:
+        args.profile = os.path.abspath(args.profile)
+        if os.path.exists(args.profile):
+            os.remove(args.profile)
+        os.environ["CRCI_PROFILE"] = args.profile
+
+    os.chdir(args.workdir)
+    sys.path.insert(0, code_dir)
+    only = set(args.only.split(",")) if args.only else None
+    force = set(args.force.split(",")) if args.force else set()
+
+    state = {"files": {}, "stages": {}, "subjects": {}}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state.update(json.load(f))
+    hasher = ContentHasher(state["files"])
+
+    for stage in stages:
+        name = stage["name"]
+        if only is not None and name not in only:
+            continue
+
+        # Parameters that change results are hashed; --jobs only changes speed and is passed separately
+        params = []
+        if name == "fc_maps" and args.fisher_z:
+            params.append("--fisher-z")
+        if stage.get("perm") and args.n_perm is not None:
+            params += ["--n-perm", str(args.n_perm)]
+
+        if stage.get("per_subject"):
+            runs = discover_runs()  # earlier stages (preprocessing) may have added runs
+            done = state["subjects"].setdefault(name, {})
+            stale = []
+            for subject, run_path in runs.items():
+                sig = signature(hasher, stage, params, [run_path])
+                outputs = [path.format(subject=subject) for path in stage["outputs"]]
+                finished = stage["subject_done"](subject) if "subject_done" in stage else all(map(os.path.exists, outputs))
+                if name in force or done.get(subject) != sig or not finished:
+                    stale.append((subject, sig))
+
+            if not stale:
+                print(f"✔️ {name}: up to date ({len(runs)} subjects)")
+                continue
+            print(f"🔄 {name}: {len(stale)} of {len(runs)} subjects stale")
+            if args.dry_run:
+                continue
+
+            # A forced stage must not be satisfied from the script's own checkpoints
+            extra = ["--jobs", str(args.jobs)] + (stage.get("force_args", []) if name in force else [])
+            command = stage_command(stage, params + extra, [s for s, _ in stale])
+            if subprocess.run(command).returncode != 0:
+                sys.exit(f"❌ Stage {name} failed")
+            for subject, sig in stale:
+                outputs = [path.format(subject=subject) for path in stage["outputs"]]
+                finished = stage["subject_done"](subject) if "subject_done" in stage else all(map(os.path.exists, outputs))
+                if finished:
+                    done[subject] = sig
+            save_state(state)
+        else:
+            sig = signature(hasher, stage, params, stage["inputs"])
+            if name not in force and state["stages"].get(name) == sig and all(map(os.path.exists, stage["outputs"])):
+                print(f"✔️ {name}: up to date")
+                continue
+            print(f"🔄 {name}: stale")
+            if args.dry_run:
+                continue
+
+            extra = ["--jobs", str(args.jobs)] if stage.get("jobs") else []
+            extra += stage.get("force_args", []) if name in force else []
+            if subprocess.run(stage_command(stage, params + extra)).returncode != 0:
+                sys.exit(f"❌ Stage {name} failed")
+            state["stages"][name] = sig
+            save_state(state)
+
+    save_state(state)
+    print("✅ Pipeline finished")
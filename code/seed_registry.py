@@ -0,0 +1,96 @@
+"""
+Single registry of the regions used by every extraction script: the seed spheres and optional atlas parcellations.
+Author: Emre Pelzer
+"""
+
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from nilearn.image import resample_to_img
+
+from mask_cache import grid_key
+from profiling import stage
+
+# Seed regions with MNI coordinates from Krönke et al. (2020)
+seeds = {
+    "mPFC": [1, 55, -3],
+    "PCC": [1, -61, 38],
+    "LP_left": [-39, -77, 33],
+    "LP_right": [47, -67, 29],
+    "ACC": [0, 22, 35],
+    "AINS_left": [-44, 13, 1],
+    "AINS_right": [47, 14, 0],
+    "RPFC_left": [-32, 45, 27],
+    "RPFC_right": [32, 46, 27],
+    "SMG_left": [-60, -39, 31],
+    "SMG_right": [62, -35, 32],
+    "Hippocampus_left": [-28, -6, -12],
+    "Hippocampus_right": [30, -8, -14],
+}
+
+radius = 6  # sphere radius in mm
+
+
+def read_label_names(path):
+    """
+    Parcel names from a .txt file (one name per line for labels 1, 2, ...) or a .csv/.tsv file whose
+    first two columns are label and name. Returns {label: name}.
+    """
+    if path.endswith(".txt"):
+        with open(path) as f:
+            names = [line.strip() for line in f if line.strip()]
+        return {i + 1: name for i, name in enumerate(names)}
+    table = pd.read_csv(path, sep="\t" if path.endswith(".tsv") else ",")
+    return {int(label): str(name) for label, name in zip(table.iloc[:, 0], table.iloc[:, 1]) if int(label) != 0}
+
+
+class Atlas:
+    """Labeled parcellation (one integer label per voxel, 0 = background) with a name per label."""
+
+    def __init__(self, img, names=None):
+        self.img = img
+        data = np.asanyarray(img.dataobj)
+        present = np.unique(data[data > 0]).astype(int)
+        self.names = names or {int(label): f"parcel_{label}" for label in present}
+        self.n_labels = int(max(present.max() if present.size else 0, max(self.names, default=0))) + 1
+        self._labels = {}
+
+    @classmethod
+    def load(cls, path, labels_path=None):
+        return cls(nib.load(path), read_label_names(labels_path) if labels_path else None)
+
+    def region_names(self):
+        return [self.names[label] for label in sorted(self.names)]
+
+    def labels_on(self, target_img):
+        """Flat C-order label per voxel of target_img's grid (nearest-neighbour resampled once per grid)."""
+        key = grid_key(target_img)
+        if key not in self._labels:
+            if key == grid_key(self.img):
+                labels = np.asanyarray(self.img.dataobj)
+            else:
+                with stage("resample"):
+                    labels = np.asanyarray(resample_to_img(self.img, target_img, interpolation="nearest",
+                                                           force_resample=True).dataobj)
+            labels = np.rint(labels).astype(np.int64).ravel()
+            labels[(labels < 0) | (labels >= self.n_labels)] = 0
+            self._labels[key] = labels
+        return self._labels[key]
+
+
+def add_region_arguments(parser):
+    """Adds --atlas / --atlas-labels; without them the seed spheres above are used."""
+    parser.add_argument("--atlas", default=None, help="labeled parcellation NIfTI used instead of the seed spheres")
+    parser.add_argument("--atlas-labels", default=None, help="parcel names (.txt one per line, or .csv/.tsv label,name)")
+
+
+def load_atlas(args):
+    """The Atlas requested on the command line, or None for the seed spheres."""
+    if not args.atlas:
+        return None
+    if not os.path.exists(args.atlas):
+        raise SystemExit(f"❌ Atlas not found: {args.atlas}")
+    atlas = Atlas.load(args.atlas, args.atlas_labels)
+    print(f"🔄 Using atlas {args.atlas} with {len(atlas.names)} parcels")
+    return atlas
@@ -0,0 +1,171 @@
+"""
+Subject-level scheduler that spreads per-subject work over worker processes.
+Author: Emre Pelzer
+"""
+
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import profiling
+from prefetch import prefetch as prefetch_ahead
+
+# Keeps the BLAS thread limit alive for the lifetime of a worker
+_thread_limit = None
+
+
+def add_pool_arguments(parser):
+    """Adds the shared --jobs / --max-memory-gb options to a script's argument parser."""
+    parser.add_argument("--jobs", type=int, default=1, help="number of subjects processed in parallel")
+    parser.add_argument("--max-memory-gb", type=float, default=None,
+                        help="address-space limit per worker process (GB), only used with --jobs > 1")
+
+
+def _init_worker(max_bytes):
+    global _thread_limit
+
+    # One BLAS thread per worker, otherwise N workers oversubscribe the cores
+    try:
+        from threadpoolctl import threadpool_limits
+        _thread_limit = threadpool_limits(limits=1)
+    except ImportError:
+        pass
+
+    if max_bytes is None:
+        return
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
+def _load_then(func, load, *args):
+    """Runs the I/O step and then the computation in one worker."""
+    return func(*load(*args))
+
+
+def _run_profiled(func, args, subject):
+    """Runs one subject in a worker and returns its profiling events along with the result."""
+    profiling.current_subject = subject
+    with profiling.stage("subject"):
+        result = func(*args)
+    return result, profiling.take_events()
+
+
+def _describe(exc):
+    if isinstance(exc, MemoryError):
+        return "out of memory (raise --max-memory-gb or lower --jobs)"
+    return f"{type(exc).__name__}: {exc}"
+
+
+def _run_pool(func, tasks, pool_kwargs, results, failures, on_result):
+    """
+    Runs tasks in one process pool, filling results and failures. Returns the tasks left unfinished (in input
+    order) when a worker process died and broke the pool, otherwise an empty list.
+    """
+    unfinished = dict(tasks)
+    with ProcessPoolExecutor(**pool_kwargs) as pool:
+        futures = {}
+        for subject, args in tasks:
+            try:
+                if profiling.enabled():
+                    futures[pool.submit(_run_profiled, func, args, subject)] = subject
+                else:
+                    futures[pool.submit(func, *args)] = subject
+            except BrokenProcessPool:
+                break
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                result = future.result()
+                if profiling.enabled():
+                    result, events = result
+                    profiling.merge(events)
+                results[subject] = on_result(subject, result) if on_result else result
+                print(f"✅ {subject} done")
+            except BrokenProcessPool:
+                continue
+            except Exception as e:
+                failures[subject] = _describe(e)
+                print(f"❌ Error processing {subject}: {failures[subject]}")
+            del unfinished[subject]
+    return list(unfinished.items())
+
+
+def run_subjects(func, tasks, jobs=1, max_memory_gb=None, on_result=None, load=None, prefetch=0, prefetch_memory_mb=1024):
+    """
+    Runs func(*args) for every (subject, args) pair in tasks.
+    With jobs > 1 subjects run in separate processes; each worker handles one subject and is then
+    replaced, so memory from a finished 4D volume is returned to the OS.
+    If on_result is given, on_result(subject, result) runs in the main process as soon as a subject
+    finishes (e.g. to write to a single-writer file) and its return value is kept instead of the result.
+    If load is given, func is called with load(*args) instead of args. In the serial loop the next `prefetch`
+    subjects are loaded in background threads (within prefetch_memory_mb) while the current one is computed;
+    with jobs > 1 each worker loads its own subject.
+    Returns (results, failures): dicts keyed by subject, in input order.
+    """
+    tasks = list(tasks)
+    results = {}
+    failures = {}
+
+    if jobs <= 1:
+        def load_task(task):
+            subject, args = task
+            if load is None:
+                return args
+            with profiling.stage("prefetch", subject):
+                return load(*args)
+
+        loaded_tasks = prefetch_ahead(tasks, load_task, depth=prefetch if load else 0, max_memory_mb=prefetch_memory_mb)
+        for (subject, _), args, error in loaded_tasks:
+            profiling.current_subject = subject
+            try:
+                if error is not None:
+                    raise error
+                with profiling.stage("subject"):
+                    result = func(*args)
+                results[subject] = on_result(subject, result) if on_result else result
+            except Exception as e:
+                failures[subject] = _describe(e)
+                print(f"❌ Error processing {subject}: {failures[subject]}")
+        profiling.current_subject = None
+    else:
+        max_bytes = int(max_memory_gb * 1024 ** 3) if max_memory_gb else None
+        if load is not None:
+            func = partial(_load_then, func, load)
+        pool_kwargs = {"max_workers": jobs, "initializer": _init_worker, "initargs": (max_bytes,)}
+        if sys.version_info >= (3, 11):
+            pool_kwargs["max_tasks_per_child"] = 1
+
+        remaining = tasks
+        while remaining:
+            remaining = _run_pool(func, remaining, pool_kwargs, results, failures, on_result)
+            if not remaining:
+                break
+            # A worker died (killed by the OS, likely out of memory) and took the pool with it. Workers take
+            # subjects in order, so the ones running were the first `jobs` unfinished: each is retried alone and
+            # only a subject that kills its worker on its own is reported; the rest go back to a fresh pool.
+            suspects, remaining = remaining[:jobs], remaining[jobs:]
+            print(f"⚠️ A worker process died, retrying {', '.join(s for s, _ in suspects)} one at a time")
+            for task in suspects:
+                if _run_pool(func, [task], {**pool_kwargs, "max_workers": 1}, results, failures, on_result):
+                    failures[task[0]] = "worker process died (killed by the OS, likely out of memory)"
+                    print(f"❌ Error processing {task[0]}: {failures[task[0]]}")
+
+    order = [subject for subject, _ in tasks]
+    results = {s: results[s] for s in order if s in results}
+    failures = {s: failures[s] for s in order if s in failures}
+    print_summary(results, failures)
+    return results, failures
+
+
+def print_summary(results, failures):
+    """Prints how many subjects finished and why the others failed."""
+    print(f"\n✅ {len(results)} subjects processed, ❌ {len(failures)} failed")
+    for subject, reason in failures.items():
+        print(f"   ❌ {subject}: {reason}")
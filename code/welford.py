@@ -0,0 +1,71 @@
+"""
+One-pass (Welford / Chan et al.) accumulator for per-voxel temporal mean, variance and linear trend.
+Author: Emre Pelzer
+"""
+
+import numpy as np
+
+
+class TemporalMoments:
+    """
+    Merges blocks of timepoints into running per-voxel statistics without keeping the blocks.
+    Besides mean and sum of squared deviations it tracks the co-moment with time, so the variance
+    left after removing a linear trend is available from the same single pass.
+    """
+
+    def __init__(self, n_voxels):
+        self.n = 0
+        self.mean = np.zeros(n_voxels)
+        self.m2 = np.zeros(n_voxels)
+        self.comoment_t = np.zeros(n_voxels)
+        self.mean_t = 0.0
+        self.m2_t = 0.0
+
+    def update(self, block, t0, voxels=None):
+        """
+        Adds a block of shape (n_voxels, n_block) holding timepoints t0 .. t0 + n_block - 1 (any float dtype),
+        or only its rows voxels. Timepoints are taken one column at a time, so apart from the block itself only
+        a few float64 vectors of n_voxels are held; pass a voxel-major (Fortran-order) block to keep columns
+        contiguous.
+        """
+        n_b = block.shape[1]
+        t = np.arange(t0, t0 + n_b, dtype=np.float64)
+        mean_t_b = t.mean()
+
+        def column(j):
+            return block[:, j] if voxels is None else block[voxels, j]
+
+        mean_b = np.zeros(self.mean.shape)
+        for j in range(n_b):
+            mean_b += column(j)
+        mean_b /= n_b
+
+        m2_b = np.zeros(self.mean.shape)
+        comoment_b = np.zeros(self.mean.shape)
+        deviation = np.empty(self.mean.shape)
+        for j in range(n_b):
+            np.subtract(column(j), mean_b, out=deviation)
+            comoment_b += deviation * (t[j] - mean_t_b)
+            deviation **= 2
+            m2_b += deviation
+        m2_t_b = np.sum((t - mean_t_b) ** 2)
+
+        n_a = self.n
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        delta_t = mean_t_b - self.mean_t
+        weight = n_a * n_b / n
+
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta ** 2 * weight
+        self.comoment_t += comoment_b + delta * delta_t * weight
+        self.mean_t += delta_t * n_b / n
+        self.m2_t += m2_t_b + delta_t ** 2 * weight
+        self.n = n
+
+    def std(self, detrend=False, ddof=0):
+        """Per-voxel temporal SD, optionally of the residuals after a least-squares linear trend."""
+        ss = self.m2
+        if detrend and self.m2_t > 0:
+            ss = self.m2 - self.comoment_t ** 2 / self.m2_t
+        return np.sqrt(np.maximum(ss, 0) / max(self.n - ddof, 1))